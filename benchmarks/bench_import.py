@@ -0,0 +1,57 @@
+"""
+Measure how long a fresh interpreter takes to start Pycco: importing
+`pycco.main`, running `pycco --help`, and documenting a single small file.
+Each command runs in a new process, so this is the latency a pre-commit hook
+or editor integration pays on every call.
+
+    python benchmarks/bench_import.py [runs]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed_runs(args, runs):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, env=env, cwd=ROOT,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timings.append((time.time() - start) * 1000)
+    return sorted(timings)
+
+
+def main(runs):
+    outdir = tempfile.mkdtemp()
+    source = os.path.join(outdir, "example.py")
+    with open(source, "w") as f:
+        f.write("# An example.\ndef example():\n    return True\n")
+
+    commands = [
+        ("python", ["-c", "pass"]),
+        ("import pycco.main", ["-c", "import pycco.main"]),
+        ("pycco --help", ["-m", "pycco.main", "--help"]),
+        ("pycco example.py", ["-m", "pycco.main", "-f", "-d", outdir,
+                              "--cache-dir", os.path.join(outdir, "cache"),
+                              source]),
+    ]
+    try:
+        print("{:<20} {:>10} {:>10}".format("command", "min ms", "median ms"))
+        for name, args in commands:
+            timings = timed_runs(args, runs)
+            print("{:<20} {:>10.1f} {:>10.1f}".format(
+                name, timings[0], timings[len(timings) // 2]))
+    finally:
+        shutil.rmtree(outdir)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
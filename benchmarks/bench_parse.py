@@ -0,0 +1,67 @@
+"""
+Compare `parse` against the implementation it replaced on synthetic Python
+files of increasing size.
+
+    python benchmarks/bench_parse.py [lines ...]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pycco.main as pycco  # noqa: E402
+from tests.legacy import legacy_parse  # noqa: E402
+
+# One repeating unit of source: a comment block, a decorated function with a
+# docstring, and a class with a method.
+UNIT = '''\
+# A comment describing the code below,
+# spread over a couple of lines.
+@decorator
+def function_{0}(argument):
+    """
+    A docstring for function_{0}.
+
+        with an indented example
+    """
+    return argument * {0}
+
+
+class Class{0}(object):
+    # The method.
+    def method(self):
+        return {0}
+'''
+
+
+def synthetic_source(lines):
+    unit_lines = UNIT.count("\n")
+    return "".join(UNIT.format(i) for i in range(max(1, lines // unit_lines)))
+
+
+def bench(parse, code, language):
+    number = 3
+    best = min(timeit.repeat(lambda: parse(code, language),
+                             number=number, repeat=3))
+    return best / number * 1000
+
+
+def main(sizes):
+    language = pycco.languages[".py"]
+    print("{:>10} {:>12} {:>12} {:>8}".format(
+        "lines", "legacy ms", "parse ms", "speedup"))
+    for lines in sizes:
+        code = synthetic_source(lines)
+        assert pycco.parse(code, language) == legacy_parse(code, language)
+        legacy = bench(legacy_parse, code, language)
+        current = bench(pycco.parse, code, language)
+        print("{:>10} {:>12.1f} {:>12.1f} {:>7.1f}x".format(
+            code.count("\n"), legacy, current, legacy / current))
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [1000, 10000, 100000, 1000000])
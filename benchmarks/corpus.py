@@ -0,0 +1,61 @@
+"""
+Synthetic source files for the benchmarks: for each language Pycco supports,
+files of a given number of lines in which a given fraction of the lines are
+comments. The output only depends on the arguments, so runs on different
+commits measure exactly the same input.
+"""
+import random
+
+# Lines of code to draw from, by Pygments lexer name. `{n}` is replaced with
+# a running number so that no two lines are identical.
+CODE = {
+    "python": ["def function_{n}(argument):", "    value = argument * {n}",
+               "    return value", "class Class{n}(object):",
+               "    name = 'class {n}'"],
+    "yaml": ["- slice_type: \"table-{n}\"", "  title: Item {n}",
+             "  data_service: \"services.Service{n}\"", "  options:",
+             "    limit: {n}"],
+    "sql": ["SELECT id, name FROM table_{n}", "WHERE value > {n}",
+            "ORDER BY name;"],
+    "bash": ["for item in $ITEMS; do", "  echo \"$item {n}\"", "done"],
+    "ruby": ["def method_{n}(argument)", "  argument * {n}", "end"],
+    "lua": ["local value_{n} = {n}", "function f_{n}(x) return x end"],
+    "haskell": ["f{n} :: Int -> Int", "f{n} x = x * {n}"],
+    "scheme": ["(define (f-{n} x)", "  (* x {n}))"],
+    "erlang": ["f{n}(X) ->", "    X * {n}."],
+}
+
+# Anything else gets C-like code.
+DEFAULT_CODE = ["int value_{n} = {n};", "if (value_{n} > 0) {{",
+                "    value_{n} = value_{n} * 2;", "}}"]
+
+WORDS = ("the quick brown fox jumps over a lazy dog while pycco renders "
+         "*emphasis* and `code` in its [[main.py]] comments").split()
+
+
+def language_names(languages):
+    """
+    Return one extension for every distinct language in `languages`.
+    """
+    extensions = {}
+    for ext, language in sorted(languages.items()):
+        extensions.setdefault(language["name"], ext)
+    return sorted(extensions.items())
+
+
+def generate(language, lines, density, seed=0):
+    """
+    Generate a source file for `language` with `lines` lines, a fraction
+    `density` of which are comments.
+    """
+    rng = random.Random("{}-{}-{}-{}".format(language["name"], lines,
+                                             density, seed))
+    code = CODE.get(language["name"], DEFAULT_CODE)
+    output = []
+    for n in range(lines):
+        if rng.random() < density:
+            words = rng.sample(WORDS, rng.randint(3, 10))
+            output.append("{} {}".format(language["symbol"], " ".join(words)))
+        else:
+            output.append(code[n % len(code)].format(n=n))
+    return "\n".join(output) + "\n"
@@ -0,0 +1,226 @@
+"""
+Benchmark the stages of Pycco's pipeline on synthetic corpora.
+
+For every language in `pycco.main.languages`, and every combination of file
+size and comment density asked for, this times `parse`, `jb_highlight`,
+`highlight` and `generate_html` on one generated file, and the full
+`process()` on a directory of such files. Each result is printed as one line
+of JSON, with sorted keys, so that runs on different commits can be diffed or
+loaded side by side:
+
+    python benchmarks/run.py -o before.jsonl
+    git checkout other-commit
+    python benchmarks/run.py -o after.jsonl
+
+Timings are the best of `--repeat` runs. Every stage of every corpus is
+measured in a fresh Python process, so that `peak_rss_kb` is the peak
+resident set size of just that measurement: the interpreter, the generated
+corpus, the input the stage is given, and the stage itself.
+"""
+from __future__ import print_function
+
+import copy
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pycco.main as pycco  # noqa: E402
+import corpus  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            stderr=subprocess.PIPE).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def best_time(run, repeat, setup=None):
+    """
+    Return the shortest of `repeat` timings of `run(setup())`.
+    """
+    timings = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        pycco.rendered_docs.clear()
+        start = time.time()
+        run(argument)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+# The stages that are measured, in order.
+STAGES = ("parse", "jb_highlight", "highlight", "generate_html", "process")
+
+
+def bench_stage(stage, ext, language, code, repeat):
+    """
+    Time one stage of documenting one file on its own. Only the stages before
+    it are run, once, to prepare its input.
+    """
+    source = "bench" + ext
+    outdir = "docs"
+    if stage == "parse":
+        return best_time(lambda _: pycco.parse(code, language), repeat)
+
+    parsed = pycco.parse(code, language)
+    if stage == "jb_highlight":
+        return best_time(
+            lambda sections: pycco.jb_highlight(sections, language, True, outdir, source),
+            repeat, lambda: copy.deepcopy(parsed))
+
+    jb = pycco.jb_highlight(parsed, language, True, outdir, source)
+    if stage == "highlight":
+        return best_time(
+            lambda sections: pycco.highlight(sections, language, outdir=outdir),
+            repeat, lambda: copy.deepcopy(jb))
+
+    highlighted = pycco.highlight(jb, language, outdir=outdir)
+    # Compile the template before anything is timed.
+    pycco.generate_html(source, highlighted, outdir=outdir)
+    return best_time(
+        lambda _: pycco.generate_html(source, highlighted, outdir=outdir),
+        repeat)
+
+
+def bench_process(ext, code, files, repeat):
+    """
+    Time a full `process()` run over a directory of `files` copies of `code`,
+    with a fresh output directory and section cache each time.
+    """
+    workdir = tempfile.mkdtemp(prefix="pycco-bench-")
+    try:
+        srcdir = os.path.join(workdir, "src")
+        os.makedirs(srcdir)
+        for i in range(files):
+            with open(os.path.join(srcdir, "file{}{}".format(i, ext)), "wb") as f:
+                # Vary each copy so that nothing is shared between files.
+                f.write("{}\n{}".format(i, code).encode("utf-8"))
+
+        cache_dir = os.path.join(workdir, "cache")
+
+        def fresh_outdir():
+            outdir = os.path.join(workdir, "docs")
+            shutil.rmtree(outdir, ignore_errors=True)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            return outdir
+
+        return best_time(
+            lambda outdir: pycco.process([srcdir], outdir=outdir, progress=None,
+                                         cache_dir=cache_dir),
+            repeat, fresh_outdir)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def measure(stage, name, lines, density, files, repeat):
+    """
+    Take one measurement, in this process: print how long `stage` took on the
+    corpus described, and the peak RSS of the process, as a line of JSON.
+    """
+    for language_name, ext in corpus.language_names(pycco.languages):
+        if language_name == name:
+            break
+    else:
+        raise ValueError("Unknown language: " + name)
+    language = pycco.languages[ext]
+    code = corpus.generate(language, lines, density)
+    if stage == "process":
+        seconds = bench_process(ext, code, files, repeat)
+    else:
+        seconds = bench_stage(stage, ext, language, code, repeat)
+    print(json.dumps({"seconds": seconds, "peak_rss_kb": peak_rss_kb()}))
+
+
+def measure_apart(stage, name, lines, density, files, repeat):
+    """
+    Run `measure` in a fresh Python process, and return what it reported.
+    """
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), "--measure", stage,
+        "-l", name, "-s", str(lines), "-d", repr(density),
+        "-f", str(files), "-r", str(repeat)])
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-l", "--language", action="append", dest="languages",
+                      help="Only benchmark this language (repeatable)")
+    parser.add_option("-s", "--sizes", default="100,1000,10000",
+                      help="Comma-separated file sizes, in lines")
+    parser.add_option("-d", "--densities", default="0.1,0.5",
+                      help="Comma-separated fractions of comment lines")
+    parser.add_option("-f", "--files", type="int", default=20,
+                      help="Number of files in each process() corpus")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="Number of runs to take the best of")
+    parser.add_option("-o", "--output", help="Write results to this file")
+    parser.add_option("--measure", metavar="STAGE",
+                      help="Take the single measurement of STAGE asked for "
+                           "by the other options, in this process")
+    opts, _ = parser.parse_args()
+
+    sizes = [int(size) for size in opts.sizes.split(",")]
+    densities = [float(density) for density in opts.densities.split(",")]
+    if opts.measure:
+        measure(opts.measure, opts.languages[0], sizes[0], densities[0],
+                opts.files, opts.repeat)
+        return
+
+    output = open(opts.output, "w") if opts.output else sys.stdout
+    common = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+    }
+
+    for name, ext in corpus.language_names(pycco.languages):
+        if opts.languages and name not in opts.languages:
+            continue
+        language = pycco.languages[ext]
+        for lines in sizes:
+            for density in densities:
+                code = corpus.generate(language, lines, density)
+                size = len(code.encode("utf-8"))
+                for stage in STAGES:
+                    measured = measure_apart(stage, name, lines, density,
+                                             opts.files, opts.repeat)
+                    seconds = measured["seconds"]
+                    files = opts.files if stage == "process" else 1
+                    result = dict(
+                        common, stage=stage, language=name, lines=lines,
+                        density=density, files=files, bytes=size * files,
+                        seconds=round(seconds, 6),
+                        files_per_sec=round(files / seconds, 3) if seconds else None,
+                        mb_per_sec=round(size * files / seconds / 1e6, 3) if seconds else None,
+                        peak_rss_kb=measured["peak_rss_kb"])
+                    print(json.dumps(result, sort_keys=True), file=output)
+                    output.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+This module holds the cache of rendered sections. Highlighting code and
+running comments through Markdown are the expensive parts of a build, and an
+edit to one function leaves every other section of the file untouched. The
+cache maps a hash of each section's text, and of whatever else its HTML
+depends on, to the HTML rendered for it last time.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from os import path
+
+from pycco.files import write_if_changed
+
+
+__all__ = ('LRUCache', 'SectionCache', 'default_cache_dir')
+
+# Part of every key, so that a change to the HTML rendered for a section can
+# be made to leave everything cached by older versions unused.
+CACHE_VERSION = 1
+
+# The cache is split into shards by this many leading hex digits of the key.
+SHARD_DIGITS = 2
+
+
+def default_cache_dir():
+    """
+    Where the cache is kept unless told otherwise: `pycco` in the user's cache
+    directory, away from any output directory that gets published.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        path.join(path.expanduser('~'), '.cache')
+    return path.join(base, 'pycco')
+
+
+class SectionCache(object):
+    """
+    A persistent map from section keys to rendered HTML, in `cache_dir`.
+
+    The entries are split into shards by the first digits of their keys, and
+    every shard is saved as a JSON file of its own. A shard is read the first
+    time one of its keys is looked up, and only written back if entries were
+    added to it, so a build that renders little reads and writes little.
+    Each shard forgets its least recently used entries once their HTML takes
+    more than its share of `max_bytes`.
+
+    Without a `cache_dir` nothing is read or saved. With `fresh`, the saved
+    shards are ignored, and overwritten by those of this build.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=64 << 20, fresh=False):
+        self.path = cache_dir
+        self.max_bytes = max_bytes
+        self.fresh = fresh
+        self.shards = {}
+        self.lock = threading.Lock()
+        # Shards with new entries, and the entries added since the last call
+        # to `take_added`.
+        self.dirty = set()
+        self.added = {}
+
+    def __getstate__(self):
+        # Pool workers start empty, and read the shards they need themselves.
+        return (self.path, self.max_bytes, self.fresh)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @staticmethod
+    def key(kind, text, *salt):
+        """
+        Build the key for a section of `kind` (`code` or `docs`) with the
+        given `text`, salted with anything else its HTML depends on.
+        """
+        digest = hashlib.sha1()
+        for part in (CACHE_VERSION, kind) + salt + (text,):
+            digest.update(u'{}\0'.format(part).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _shard_path(self, name):
+        return path.join(self.path, name + '.json')
+
+    def _shard(self, name):
+        with self.lock:
+            shard = self.shards.get(name)
+            if shard is not None:
+                return shard
+
+            shard = LRUCache(self.max_bytes >> (4 * SHARD_DIGITS), sizeof=len)
+            if self.path is not None and not self.fresh:
+                try:
+                    with open(self._shard_path(name), 'rb') as f:
+                        entries = json.loads(f.read().decode('utf-8'))
+                except (IOError, OSError, ValueError):
+                    entries = {}
+                if isinstance(entries, dict):
+                    for key in sorted(entries):
+                        shard[key] = entries[key]
+            self.shards[name] = shard
+            return shard
+
+    def get(self, key):
+        return self._shard(key[:SHARD_DIGITS]).get(key)
+
+    def set(self, key, value):
+        self.update({key: value})
+        self.added[key] = value
+
+    def take_added(self):
+        """
+        Return, and stop tracking, the entries added since the last call.
+        Pool workers use this to send their new entries back to the parent.
+        """
+        added, self.added = self.added, {}
+        return added
+
+    def trim(self):
+        """
+        Stop tracking the entries added to a cache that is never saved, like
+        that of a long-running server. The shards bound themselves.
+        """
+        self.take_added()
+
+    def update(self, entries):
+        for key, value in entries.items():
+            name = key[:SHARD_DIGITS]
+            self._shard(name)[key] = value
+            self.dirty.add(name)
+
+    def save(self):
+        """
+        Write the shards with new entries back to disk. A shard is left alone
+        if its contents didn't change.
+        """
+        if self.path is None:
+            return
+
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+        dirty, self.dirty = self.dirty, set()
+        for name in sorted(dirty):
+            shard = self.shards[name]
+            with shard.lock:
+                entries = dict(shard.entries)
+            write_if_changed(self._shard_path(name),
+                             json.dumps(entries, sort_keys=True).encode('utf-8'))
+
+
+class LRUCache(object):
+    """
+    A small in-memory map that forgets its least recently used entries once
+    it holds more than `maxsize` of them. It is safe to share between threads.
+
+    With a `sizeof` function, `maxsize` bounds the total `sizeof(value)` of
+    the entries instead of their number.
+    """
+
+    def __init__(self, maxsize=1024, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _sizeof(self, value):
+        return self.sizeof(value) if self.sizeof is not None else 1
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self._sizeof(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += self._sizeof(value)
+            # The newest entry is always kept, even if it is too big alone.
+            while self.size > self.maxsize and len(self.entries) > 1:
+                self.size -= self._sizeof(self.entries.popitem(last=False)[1])
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,177 @@
+"""
+Precompressed copies of the output, for `pycco --compress`. Next to each page
+a `.gz` copy is written, and a `.br` copy too when the optional `brotli`
+package is installed, so that a static web server can send those bytes as
+they are instead of compressing the page on every request.
+
+What each set of copies was made from is recorded in the output directory,
+like the sources in the manifest: the size, mtime and hash of the file. Output
+files that didn't change are never rewritten, so an incremental build only
+compresses the pages that did.
+"""
+import functools
+import gzip
+import hashlib
+import io
+import json
+import os
+from os import path
+
+from pycco.files import atomic_write, write_if_changed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+__all__ = ('CompressedCopies', 'available_formats', 'compress_file',
+           'remove_compressed')
+
+# Name of the record of compressed copies, relative to the output directory.
+RECORD_NAME = '.pycco-compressed'
+
+
+def _gzip(data):
+    out = io.BytesIO()
+    # Leave the name and timestamp out of the header, so that the same page
+    # always compresses to the same bytes.
+    with gzip.GzipFile(filename='', mode='wb', fileobj=out, compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _brotli(data):
+    return brotli.compress(data)
+
+
+# The extension of each kind of copy, and how to make it.
+COMPRESSORS = {'gz': _gzip, 'br': _brotli}
+
+
+def available_formats():
+    """
+    The extensions of the copies that can be made: `gz`, and `br` if the
+    `brotli` package is installed.
+    """
+    return ['gz', 'br'] if brotli is not None else ['gz']
+
+
+def _mtime(stat):
+    # Nanoseconds where the platform has them. Either way the value survives
+    # a round trip through JSON exactly.
+    return getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+
+def compress_file(file_path, formats, entry=None):
+    """
+    Write the copies of `file_path` in `formats`, unless `entry`, the record
+    of the copies made last time, shows they are up to date. A matching size
+    and mtime is trusted outright; otherwise the file is hashed, so that one
+    rewritten with the same contents isn't compressed again. Returns the new
+    record, or None if the file is gone, and the paths of the copies written.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None, []
+    copies = ['{}.{}'.format(file_path, ext) for ext in formats]
+    fresh = entry is not None and entry['size'] == stat.st_size and \
+        sorted(entry['formats']) == sorted(formats) and \
+        all(path.exists(copy_path) for copy_path in copies)
+    if fresh and entry['mtime'] == _mtime(stat):
+        return entry, []
+
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    written = []
+    if not fresh or entry['digest'] != digest:
+        for ext, copy_path in zip(formats, copies):
+            atomic_write(copy_path, COMPRESSORS[ext](data))
+            written.append(copy_path)
+    return {'size': stat.st_size, 'mtime': _mtime(stat), 'digest': digest,
+            'formats': list(formats)}, written
+
+
+def _compress_job(job, formats):
+    file_path, entry = job
+    return (file_path,) + compress_file(file_path, formats, entry)
+
+
+class CompressedCopies(object):
+    """
+    The compressed copies of the files in an output directory, made in
+    `formats`, on the threads of `pool` if there is one. zlib and brotli let
+    go of the GIL while they work.
+    """
+
+    def __init__(self, outdir, formats, pool=None):
+        self.outdir = outdir
+        self.path = path.join(outdir, RECORD_NAME)
+        self.formats = list(formats)
+        self.pool = pool
+        self.entries = {}
+
+    @classmethod
+    def load(cls, outdir, formats, pool=None):
+        """
+        Read the record of the copies in `outdir`, or start an empty one.
+        """
+        copies = cls(outdir, formats, pool)
+        try:
+            with open(copies.path, 'rb') as f:
+                entries = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return copies
+
+        if isinstance(entries, dict):
+            copies.entries = entries
+        return copies
+
+    def _key(self, file_path):
+        return path.relpath(file_path, self.outdir)
+
+    def compress(self, file_paths):
+        """
+        Bring the copies of every file in `file_paths` up to date. Returns
+        the number of copies that were written.
+        """
+        jobs = [(file_path, self.entries.get(self._key(file_path)))
+                for file_path in file_paths]
+        run = functools.partial(_compress_job, formats=self.formats)
+        if self.pool is None:
+            results = map(run, jobs)
+        else:
+            results = self.pool.imap_unordered(run, jobs, 8)
+
+        count = 0
+        for file_path, entry, written in results:
+            if entry is None:
+                self.entries.pop(self._key(file_path), None)
+            else:
+                self.entries[self._key(file_path)] = entry
+            count += len(written)
+        return count
+
+    def save(self):
+        """
+        Write the record back to the output directory, without the entries
+        of files that are gone.
+        """
+        entries = dict((key, entry) for key, entry in self.entries.items()
+                       if path.exists(path.join(self.outdir, key)))
+        write_if_changed(self.path, json.dumps(
+            entries, sort_keys=True, indent=1).encode('utf-8'))
+
+
+def remove_compressed(file_path):
+    """
+    Remove every compressed copy of `file_path`, when it is removed itself.
+    """
+    for ext in COMPRESSORS:
+        try:
+            os.remove('{}.{}'.format(file_path, ext))
+        except OSError:
+            pass
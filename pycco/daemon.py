@@ -0,0 +1,170 @@
+"""
+A long-running Pycco that renders single files on request, for editor
+integrations and commit hooks that would otherwise start a new `pycco`
+process, and build its lexers, Markdown converter and template again, for
+every file.
+
+`serve(socket_path)` listens on a local Unix socket. Each request is one line
+of JSON, and gets one line of JSON back, and a connection may be used for any
+number of them. A request names the `source` file and may give:
+
+  * `code`: the text to document, instead of reading `source` from disk;
+  * `outdir`, `preserve_paths`, `language` and `encoding`, as for
+    `generate_documentation`.
+
+The reply is `{"html": ...}` with the page, or `{"error": ...}`. `render()` is
+a client for it:
+
+    html = render("/tmp/pycco.sock", "pycco/main.py", outdir="docs")
+"""
+from __future__ import print_function
+
+import json
+import os
+import socket
+import stat
+
+from pycco.cache import SectionCache
+import pycco.main as pycco
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+__all__ = ('serve', 'render', 'RenderServer', 'DaemonError')
+
+
+class DaemonError(Exception):
+    """
+    An error reported back by the daemon.
+    """
+
+
+def handle_request(request, cache=None):
+    """
+    Render the page asked for by a decoded `request`.
+    """
+    source = request["source"]
+    outdir = request.get("outdir") or "docs"
+    preserve_paths = request.get("preserve_paths", True)
+    language = request.get("language")
+    code = request.get("code")
+    if code is None:
+        with open(source, "rb") as f:
+            code = f.read().decode(request.get("encoding") or "utf8")
+
+    try:
+        return pycco._generate_documentation(source, code, outdir,
+                                             preserve_paths, language,
+                                             cache=cache)
+    finally:
+        if cache is not None:
+            cache.trim()
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                html = handle_request(json.loads(line.decode("utf-8")),
+                                      self.server.cache)
+                reply = {"html": html.decode("utf-8")}
+            except Exception as e:
+                reply = {"error": "{}: {}".format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Each connection is handled on a thread of its own, so a client that keeps
+    its connection open doesn't hold up the others. Every thread builds its
+    own Markdown converter, and keeps it warm for the requests that follow.
+
+    A socket left behind at `socket_path` is replaced, but nothing else is,
+    and the new socket is only open to its owner.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, cache=None):
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except OSError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise OSError("{} exists and is not a socket".format(
+                    socket_path))
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, RenderHandler)
+        self.cache = cache if cache is not None else SectionCache()
+
+    def server_bind(self):
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def warm_up():
+    """
+    Build everything a render needs up front: every lexer, the template and
+    the Markdown converter.
+    """
+    for language in pycco.languages.values():
+        language["lexer"]
+    pycco.pycco_template.compile()
+    pycco.render_markdown("")
+
+
+def serve(socket_path):
+    """
+    Answer render requests on `socket_path` until interrupted.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise OSError("The render daemon needs Unix domain sockets.")
+    warm_up()
+    server = RenderServer(socket_path)
+    print("pycco: serving renders on {}".format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def render(socket_path, source, code=None, outdir="docs", preserve_paths=True,
+           language=None, encoding="utf8"):
+    """
+    Ask the daemon at `socket_path` to render `source`, and return the page.
+    """
+    request = dict(source=source, code=code, outdir=outdir,
+                   preserve_paths=preserve_paths, language=language,
+                   encoding=encoding)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        reply = client.makefile("rb").readline()
+    finally:
+        client.close()
+
+    reply = json.loads(reply.decode("utf-8"))
+    if "error" in reply:
+        raise DaemonError(reply["error"])
+    return reply["html"].encode("utf-8")
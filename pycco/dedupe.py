@@ -0,0 +1,65 @@
+"""
+Sharing the work of documenting identical files. Vendored libraries and
+generated files often appear many times over in a tree, byte for byte the
+same. The first copy of such a file to be rendered leaves its parsed
+sections and highlighted code here, and the other copies only redo what
+depends on where their page is: the title, the stylesheet path, the "Back to
+top" link and cross-reference links.
+"""
+from collections import defaultdict
+
+
+__all__ = ('Duplicates',)
+
+
+class Duplicates(object):
+    """
+    The sources of a build that have the same contents as another source,
+    given their `digests`. What a copy leaves behind is kept only until the
+    last copy with its contents has been rendered.
+    """
+
+    def __init__(self, digests):
+        counts = defaultdict(int)
+        for digest in digests.values():
+            counts[digest] += 1
+        self.digests = dict((source, digest)
+                            for source, digest in digests.items()
+                            if counts[digest] > 1)
+        self.remaining = dict((digest, count)
+                              for digest, count in counts.items() if count > 1)
+        self.pages = {}
+
+    def __len__(self):
+        return len(self.digests)
+
+    def get(self, source, language):
+        """
+        The parsed sections and highlighted code left by an earlier copy of
+        `source` in the same `language`, or None.
+        """
+        digest = self.digests.get(source)
+        if digest is None:
+            return None
+        return self.pages.get((digest, language["name"]))
+
+    def wants(self, source):
+        return source in self.digests
+
+    def put(self, source, language, sections, code_html):
+        self.pages[(self.digests[source], language["name"])] = \
+            (sections, code_html)
+
+    def done(self, source):
+        """
+        Note that `source` has been rendered, and forget its contents once
+        every copy has been.
+        """
+        digest = self.digests.pop(source, None)
+        if digest is None:
+            return
+        self.remaining[digest] -= 1
+        if not self.remaining[digest]:
+            del self.remaining[digest]
+            for key in [key for key in self.pages if key[0] == digest]:
+                del self.pages[key]
@@ -0,0 +1,92 @@
+"""
+Writing output files. Every file Pycco writes goes through a temporary file
+in the same directory that is then renamed over the destination, so readers
+never see a half-written page, and a file whose contents wouldn't change is
+not touched at all, so that its mtime only moves when it really changed.
+"""
+import os
+import threading
+from os import path
+
+
+__all__ = ('atomic_write', 'write_if_changed', 'replace_if_changed',
+           'temporary_path')
+
+
+def temporary_path(file_path):
+    """
+    A name to write the new contents of `file_path` to before renaming it,
+    unique to this process and thread.
+    """
+    return '{}.{}-{}.tmp'.format(file_path, os.getpid(),
+                                 threading.current_thread().ident)
+
+
+def _replace(tmp_path, file_path):
+    if os.name == 'nt' and path.exists(file_path):
+        os.remove(file_path)
+    os.rename(tmp_path, file_path)
+
+
+def atomic_write(file_path, data):
+    """
+    Replace the contents of `file_path` with the bytes `data`.
+    """
+    tmp_path = temporary_path(file_path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        _replace(tmp_path, file_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _same_contents(file_path, data=None, other_path=None, chunk_size=1 << 16):
+    """
+    Does `file_path` hold exactly the bytes `data`, or the same bytes as the
+    file at `other_path`?
+    """
+    try:
+        size = os.stat(file_path).st_size
+        expected = len(data) if other_path is None else \
+            os.stat(other_path).st_size
+        if size != expected:
+            return False
+        with open(file_path, 'rb') as f:
+            if other_path is None:
+                return f.read() == data
+            with open(other_path, 'rb') as other:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if chunk != other.read(chunk_size):
+                        return False
+                    if not chunk:
+                        return True
+    except (IOError, OSError):
+        return False
+
+
+def write_if_changed(file_path, data):
+    """
+    Write the bytes `data` to `file_path`, unless that's what it holds
+    already. Returns whether the file was written.
+    """
+    if _same_contents(file_path, data):
+        return False
+    atomic_write(file_path, data)
+    return True
+
+
+def replace_if_changed(tmp_path, file_path):
+    """
+    Rename the finished file at `tmp_path` over `file_path`, unless the two
+    are the same, in which case it is removed instead. Returns whether
+    `file_path` was replaced.
+    """
+    if _same_contents(file_path, other_path=tmp_path):
+        os.remove(tmp_path)
+        return False
+    _replace(tmp_path, file_path)
+    return True
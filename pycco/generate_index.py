@@ -1,15 +1,25 @@
 """
 This is the module responsible for automatically generating an HTML index of
 all documentation files generated by Pycco.
+
+For very large trees, `write_sharded_index` writes one index per directory
+instead of a single page listing everything.
 """
-import re
+import hashlib
+import json
+import os
 from os import path
 
 from pycco.compat import compat_items
-from pycco_resources import pycco_template
+from pycco.files import write_if_changed
+from pycco_resources import html as template_source, pycco_template
+
 
+__all__ = ('generate_index', 'write_sharded_index')
 
-__all__ = ('generate_index',)
+# Name of the record of the sharded index pages, relative to the output
+# directory.
+SHARDS_NAME = '.pycco-index'
 
 
 def build_tree(file_paths, outdir):
@@ -79,4 +89,142 @@ def generate_index(files, outdir):
         "source": '',
     })
 
-    return re.sub(r"__DOUBLE_OPEN_STACHE__", "{{", rendered).encode("utf-8")
+    return rendered.encode("utf-8")
+
+
+def index_page_name(number):
+    return 'index.html' if number == 1 else 'index-{}.html'.format(number)
+
+
+def display_name(filename):
+    """
+    The name of a source file, given the name of its page.
+    """
+    parts = filename.split('.')
+    if len(parts) == 3 and parts[-1] == 'html':
+        return '.'.join(parts[:-1])
+    return filename
+
+
+def build_directories(file_paths, outdir):
+    """
+    Map the path of every directory under `outdir`, relative to it and with
+    the root as `''`, to the sorted names of its subdirectories and pages.
+    """
+    directories = {'': (set(), [])}
+    for file_path in file_paths:
+        dirname, filename = path.split(path.relpath(file_path, outdir))
+        directories.setdefault(dirname, (set(), []))[1].append(filename)
+        while dirname:
+            parent, name = path.split(dirname)
+            subdirs = directories.setdefault(parent, (set(), []))[0]
+            if name in subdirs:
+                break
+            subdirs.add(name)
+            dirname = parent
+    return dict((d, (sorted(subdirs), sorted(files)))
+                for d, (subdirs, files) in compat_items(directories))
+
+
+def render_directory_pages(dirname, subdirs, files, page_size):
+    """
+    Render the index pages of one directory: links to its subdirectories,
+    then to its pages, `page_size` entries per index page.
+    """
+    depth = len(dirname.split(path.sep)) if dirname else 0
+    entries = [(u'{}/index.html'.format(d), d + u'/') for d in subdirs]
+    entries.extend((f, display_name(f)) for f in files)
+    count = max(1, (len(entries) + page_size - 1) // page_size)
+
+    pages = []
+    for number in range(1, count + 1):
+        links = []
+        if dirname:
+            links.append(u'<a href="../index.html">Up</a>')
+        if number > 1:
+            links.append(u'<a href="{}">Previous</a>'.format(
+                index_page_name(number - 1)))
+        if number < count:
+            links.append(u'<a href="{}">Next</a>'.format(
+                index_page_name(number + 1)))
+        if count > 1:
+            links.append(u'Page {} of {}'.format(number, count))
+
+        start = (number - 1) * page_size
+        listing = u''.join(u'<li><a href="{}">{}</a></li>'.format(href, text)
+                           for href, text in entries[start:start + page_size])
+        rendered = pycco_template({
+            "title": u'Index of {}'.format(dirname.replace(path.sep, u'/') or u'/'),
+            "stylesheet": u'../' * depth + u'pycco.css',
+            "sections": {'docs_html': u'<p>{}</p><ul>{}</ul>'.format(
+                u' | '.join(links), listing)},
+            "source": '',
+        })
+        pages.append(rendered.encode("utf-8"))
+    return pages
+
+
+def write_sharded_index(files, outdir, page_size=500, compress=None):
+    """
+    Write an index for every directory of the generated `files`, each split
+    into pages of `page_size` entries, with `index.html` in `outdir` at the
+    top of the hierarchy. What each directory's index lists is recorded in
+    `outdir`, so only the directories whose contents changed are rendered
+    again, and pages are only written if they differ from the ones on disk.
+    Returns the directories whose index was written.
+
+    Given the `CompressedCopies` of `outdir` as `compress`, the compressed
+    copies of the pages are brought up to date too.
+    """
+    shards_path = path.join(outdir, SHARDS_NAME)
+    try:
+        with open(shards_path, 'rb') as f:
+            previous = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        previous = {}
+    if not isinstance(previous, dict):
+        previous = {}
+
+    template_digest = hashlib.sha1(template_source.encode('utf-8')).hexdigest()
+    shards, written = {}, []
+    for dirname, (subdirs, names) in sorted(compat_items(
+            build_directories(files, outdir))):
+        digest = hashlib.sha1(json.dumps(
+            [template_digest, page_size, subdirs, names]).encode('utf-8'))
+        pages = max(1, (len(subdirs) + len(names) + page_size - 1) // page_size)
+        shards[dirname] = [digest.hexdigest(), pages]
+
+        directory = path.join(outdir, dirname)
+        if previous.get(dirname) == shards[dirname] and \
+                path.exists(path.join(directory, 'index.html')):
+            continue
+        if not path.isdir(directory):
+            os.makedirs(directory)
+        changed = False
+        for number, page in enumerate(
+                render_directory_pages(dirname, subdirs, names, page_size), 1):
+            if write_if_changed(path.join(directory, index_page_name(number)),
+                                page):
+                changed = True
+        if changed:
+            written.append(dirname)
+
+    # Remove the pages of directories that are gone, or have shrunk.
+    from pycco.compress import remove_compressed
+    for dirname, shard in compat_items(previous):
+        pages = shards[dirname][1] if dirname in shards else 0
+        for number in range(pages + 1, shard[1] + 1):
+            page_path = path.join(outdir, dirname, index_page_name(number))
+            try:
+                os.remove(page_path)
+            except OSError:
+                pass
+            remove_compressed(page_path)
+
+    write_if_changed(shards_path,
+                     json.dumps(shards, sort_keys=True).encode('utf-8'))
+    if compress is not None:
+        compress.compress([path.join(outdir, dirname, index_page_name(number))
+                           for dirname, shard in sorted(compat_items(shards))
+                           for number in range(1, shard[1] + 1)])
+    return written
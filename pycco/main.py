@@ -4,18 +4,27 @@ from __future__ import print_function
 # This module contains all of our static resources.
 from pycco_resources import pycco_template, css as pycco_css
 
-# Import our external dependencies.
+# Import our standard library dependencies. Markdown and Pygments are slow to
+# import, so they are only imported by the functions that use them.
+import functools
+import itertools
 import optparse
 import os
-import pygments
 import re
 import sys
+import threading
 import time
+import pycco.files as files
 import pycco.generate_index as generate_index
+import pycco.pipeline as pipeline
+import pycco.profiling as profiling
+
+from pycco.cache import LRUCache, SectionCache, default_cache_dir
+from pycco.dedupe import Duplicates
+from pycco.manifest import Manifest, build_settings
+from pycco.xref import CrossReferences
 
-from markdown import markdown
 from os import path
-from pygments import lexers, formatters
 
 """
 "**Pycco**" is a Python port of [Docco](http://jashkenas.github.com/docco/):
@@ -52,20 +61,96 @@ Or, to install the latest source
 
 
 def generate_documentation(source, outdir=None, preserve_paths=True,
-                           language=None, encoding="utf8"):
+                           language=None, encoding="utf8", cache=None, xref=None,
+                           search=False):
     """
     Generate the documentation for a source file by reading it in, splitting it
     up into comment/code sections, highlighting them for the appropriate
-    language, and merging them into an HTML template.
+    language, and merging them into an HTML template. With `search`, the page
+    gets a search box for the search index of the build.
+    """
+
+    if not outdir:
+        raise TypeError("Missing the required 'outdir' keyword argument.")
+    with profiling.source_file(source):
+        code, language = _read_code(source, encoding, language)
+        return _generate_documentation(source, code, outdir, preserve_paths, language,
+                                       cache=cache, xref=xref, search=search)
+
+
+def write_documentation(source, dest, outdir=None, preserve_paths=True,
+                        language=None, encoding="utf8", cache=None, xref=None,
+                        duplicates=None, search=False):
+    """
+    Generate the documentation for a source file like `generate_documentation`,
+    but stream the page into the file at `dest` as it is rendered: the header,
+    then each section, then the footer. The whole page is never held in
+    memory, neither as text nor encoded.
+
+    The page is written to a temporary file first, which only replaces `dest`
+    if it differs from it. Returns whether `dest` was replaced.
     """
 
     if not outdir:
         raise TypeError("Missing the required 'outdir' keyword argument.")
-    code = open(source, "rb").read().decode(encoding)
-    return _generate_documentation(source, code, outdir, preserve_paths, language)
+    with profiling.source_file(source):
+        code, language = _read_code(source, encoding, language)
+        chunks = _iter_documentation(source, code, outdir, preserve_paths, language,
+                                     cache=cache, xref=xref, duplicates=duplicates,
+                                     search=search)
+
+        return _write_chunks(dest, chunks)
+
+
+def _write_chunks(dest, chunks):
+    """
+    Write the encoded `chunks` of a page to a temporary file as they come,
+    then replace `dest` with it if the two differ. The page only replaces
+    `dest` once it is complete, so a file that fails to render halfway
+    through never truncates it. Returns whether `dest` was replaced.
+    """
+    tmp_path = files.temporary_path(dest)
+    try:
+        with open(tmp_path, "wb") as f, \
+                profiling.accumulate("write", f.write) as write:
+            for chunk in chunks:
+                write(chunk)
+    except BaseException:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return files.replace_if_changed(tmp_path, dest)
+
+
+# Data Service classes, and the references YAML slices make to them.
+service_matcher = re.compile('^class (\w*Service\w*)\(.*Service\)')
+data_service_matcher = re.compile('data_service: "(\S*)\.(\S*)"')
 
 
-def jb_highlight(sections, language, preserve_paths, outdir, file_path):
+def _read_code(source, encoding, language=None, digest=None):
+    """
+    Read the code of `source` for `_iter_documentation`, lazily, a line at a
+    time, as it is parsed. Return it with its language, which is worked out
+    from the start of the file if its name doesn't give it away. The bytes
+    read are fed to the hash object `digest`, if there is one.
+    """
+    lines = profiling.timed_iter("read", iter_source_lines(source, encoding,
+                                                           digest=digest))
+    found = _named_language(source, language)
+    if found is None:
+        head, size = [], 0
+        with profiling.stage("language"):
+            for line in lines:
+                head.append(line)
+                size += len(line) + 1
+                if size > GUESS_CHARS:
+                    break
+            found = get_language(source, "\n".join(head))
+        lines = itertools.chain(head, lines)
+    return lines, found
+
+
+def jb_highlight(sections, language, preserve_paths, outdir, file_path, xref=None):
     """ Inject juicebox specific links """
     num_slashes = len(file_path.split('/'))-1
     newsections = [ {"docs_text": "[Back to top]({"
@@ -76,8 +161,7 @@ def jb_highlight(sections, language, preserve_paths, outdir, file_path):
     for section in sections:
         if language['name'] == 'python':
             # Insert a section for each data service
-            match = re.match('^class (\w*Service\w*)\(.*Service\)', section[
-                "code_text"])
+            match = service_matcher.match(section["code_text"])
             if match:
                 newsections.append({
                     "docs_text": "=== {} ===".format(match.groups()[0]),
@@ -95,13 +179,17 @@ def jb_highlight(sections, language, preserve_paths, outdir, file_path):
                                                                                 slicetype.replace('-','')) + section["docs_text"]
 
             # Crossreference data services
-            match = re.search('data_service: "(\S*)\.(\S*)"', section[
-                "code_text"])
+            match = data_service_matcher.search(section["code_text"])
             if match:
                 dataservices_file, classname = match.groups()
                 if classname != "json":
-                    section["docs_text"] += "\n[See dataservice]({}.py.html#{" \
-                                            "}) ".format(dataservices_file, classname.lower())
+                    href = None
+                    if xref is not None:
+                        href = xref.service(dataservices_file, classname)
+                    if href is None:
+                        href = "{}.py.html#{}".format(dataservices_file,
+                                                      classname.lower())
+                    section["docs_text"] += "\n[See dataservice]({}) ".format(href)
 
             # Inject images
             match = re.search('(?:image): (?:\'|\")(.*\.(gif|jpg|jpeg|png))('
@@ -117,15 +205,160 @@ def jb_highlight(sections, language, preserve_paths, outdir, file_path):
     return newsections
 
 
-def _generate_documentation(file_path, code, outdir, preserve_paths, language):
+def _generate_documentation(file_path, code, outdir, preserve_paths, language,
+                            cache=None, xref=None, duplicates=None, search=False):
     """
     Helper function to allow documentation generation without file handling.
     """
-    language = get_language(file_path, code, language=language)
-    sections = parse(code, language)
-    sections = jb_highlight(sections, language, preserve_paths=preserve_paths, outdir=outdir, file_path=file_path)
-    highlight(sections, language, preserve_paths=preserve_paths, outdir=outdir)
-    return generate_html(file_path, sections, preserve_paths=preserve_paths, outdir=outdir)
+    return b"".join(_iter_documentation(file_path, code, outdir, preserve_paths,
+                                        language, cache=cache, xref=xref,
+                                        duplicates=duplicates, search=search))
+
+
+def _iter_documentation(file_path, code, outdir, preserve_paths, language,
+                        cache=None, xref=None, duplicates=None, search=False):
+    """
+    Generate the documentation for `code` as a series of encoded chunks of the
+    page. Cross-references are resolved through the `xref` index of the
+    build, if there is one.
+
+    If `file_path` is one of several identical files in `duplicates`, the
+    sections and code highlighted for an earlier copy are reused.
+    """
+    if xref is not None:
+        xref = xref.for_page(destination(file_path, preserve_paths=preserve_paths,
+                                         outdir=outdir))
+    sections = _iter_sections(file_path, code, outdir, preserve_paths, language,
+                              cache=cache, xref=xref, duplicates=duplicates)
+    html = iter_html(file_path, sections, preserve_paths=preserve_paths,
+                     outdir=outdir, search=search)
+    for chunk in profiling.timed_iter("template", html, file_path):
+        yield chunk.encode("utf-8")
+
+
+# The sections of a page are highlighted and rendered in windows of about this
+# many characters of text.
+WINDOW_CHARS = 1 << 18
+
+
+def _windows(sections, size=WINDOW_CHARS):
+    """
+    Group `sections` into lists of about `size` characters of text each. There
+    is always at least one list, even if it is empty.
+    """
+    window, chars, count = [], 0, 0
+    for section in sections:
+        window.append(section)
+        chars += len(section["docs_text"]) + len(section["code_text"])
+        if chars >= size:
+            yield window
+            window, chars, count = [], 0, count + 1
+    if window or not count:
+        yield window
+
+
+def _iter_sections(file_path, code, outdir, preserve_paths, language,
+                   cache=None, xref=None, duplicates=None):
+    """
+    Yield the sections of the page for `code`, parsed, highlighted and
+    rendered. The sections go through each stage a window of `WINDOW_CHARS`
+    at a time, so that only the window being rendered is held in memory,
+    whatever the size of the file. A token that spans two windows, like a
+    very long string, is lexed as two.
+
+    Only when `file_path` has copies to come in `duplicates` are all of its
+    sections kept, for the copies to reuse. Only the first window goes into
+    `cache`: the cache would otherwise hold all the HTML of a large file until
+    it is done, and push out that of every other file.
+    """
+    try:
+        with profiling.stage("language", file_path):
+            language = get_language(file_path, code, language=language)
+        copy = duplicates.get(file_path, language) if duplicates else None
+        keep = copy is None and duplicates and duplicates.wants(file_path)
+        if copy is not None:
+            sections = (dict(section) for section in copy[0])
+            copied_html = iter(copy[1])
+        else:
+            sections = iter_parse(code, language)
+        parsed, code_html = [], []
+        num = 0
+        sections = profiling.timed_iter("parse", sections, file_path)
+        for window in _windows(sections, WINDOW_CHARS):
+            if keep:
+                parsed.extend(dict(section) for section in window)
+            with profiling.stage("jb_highlight", file_path):
+                window = jb_highlight(window, language, preserve_paths=preserve_paths, outdir=outdir, file_path=file_path, xref=xref)
+            if num:
+                # Only the first window starts the page, with the link back
+                # to the top.
+                del window[0]
+                cache = None
+            with profiling.source_file(file_path):
+                highlight(window, language, preserve_paths=preserve_paths,
+                          outdir=outdir, cache=cache, xref=xref,
+                          code_html=list(itertools.islice(copied_html, len(window)))
+                          if copy is not None else None)
+            for section in window:
+                section["num"] = num
+                num += 1
+                if keep:
+                    code_html.append(section["code_html"])
+                yield section
+        if keep:
+            duplicates.put(file_path, language, parsed, code_html)
+    finally:
+        if duplicates:
+            duplicates.done(file_path)
+
+
+# Patterns used by `parse`, compiled once rather than on every line.
+coding_matcher = re.compile(r'coding[:=]\s*([-\w.]+)')
+indent_matcher = re.compile(r'\s*')
+
+# Code lines that start a new section even without a comment before them.
+section_starts = ('class ', 'def ', '@')
+
+
+def split_lines(chunks):
+    """
+    Yield the lines of the text made up of the string `chunks`, exactly as
+    `text.split("\n")` would return them, without ever joining the text.
+    """
+    rest = ""
+    for chunk in chunks:
+        if rest:
+            chunk = rest + chunk
+        start = 0
+        end = chunk.find("\n")
+        while end >= 0:
+            yield chunk[start:end]
+            start = end + 1
+            end = chunk.find("\n", start)
+        rest = chunk[start:]
+    yield rest
+
+
+def iter_source_lines(source, encoding="utf8", chunk_size=1 << 16,
+                      digest=None):
+    """
+    Yield the lines of the file `source` as `split_lines` would, reading and
+    decoding it a chunk at a time, so that the whole file is never in memory.
+    Every chunk read is also fed to the hash object `digest`, if given.
+    """
+    import codecs
+
+    decoder = codecs.getincrementaldecoder(encoding)()
+
+    def chunks():
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                if digest is not None:
+                    digest.update(chunk)
+                yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+    return split_lines(chunks())
 
 
 def parse(code, language):
@@ -140,20 +373,48 @@ def parse(code, language):
           "code_html": ...,
           "num":       ...
         }
+
+    `code` may also be an iterable of lines, without their newlines, like the
+    ones `iter_source_lines` yields. `iter_parse` yields the same sections one
+    at a time.
+    """
+    return list(iter_parse(code, language))
+
+
+def iter_parse(code, language):
     """
+    Yield the sections of `code`, a string or an iterable of lines, as soon as
+    each is complete.
 
-    lines = code.split("\n")
+    The file is read in a single pass. The text of the section being built up
+    is collected in lists of lines, which are only joined when the section is
+    saved.
+    """
+
+    if isinstance(code, (type(u""), str)):
+        # The text is in memory already, and `split` is much faster.
+        lines = iter(code.split("\n"))
+    else:
+        lines = iter(code)
     sections = []
-    has_code = docs_text = code_text = ""
 
-    if lines[0].startswith("#!"):
-        lines.pop(0)
+    # Only the first few lines can be a shebang or a coding declaration.
+    head = list(itertools.islice(lines, 3))
+    if head and head[0].startswith("#!"):
+        head.pop(0)
 
     if language["name"] == "python":
-        for linenum, line in enumerate(lines[:2]):
-            if re.search(r'coding[:=]\s*([-\w.]+)', lines[linenum]):
-                lines.pop(linenum)
+        for linenum, line in enumerate(head[:2]):
+            if coding_matcher.search(line):
+                head.pop(linenum)
                 break
+    lines = itertools.chain(head, lines)
+
+    # The section being built: its comment lines (each ending in a newline),
+    # its code lines, whether any comment line has text in it, and the first
+    # non-blank character of its code.
+    docs, code_lines = [], []
+    docs_blank, code_lead = True, ""
 
     def save(docs, code):
         if docs or code:
@@ -166,23 +427,25 @@ def parse(code, language):
     multi_line = False
     multi_string = False
     multistart, multiend = language.get("multistart"), language.get("multiend")
+    delimiters = (multistart, multiend) if multistart and multiend else None
     comment_matcher = language['comment_matcher']
+    is_yaml = language["name"] == 'yaml'
+    indent, indent_length = "", 0
 
     for line in lines:
         process_as_code = False
         # Only go into multiline comments section when one of the delimiters is
         # found to be at the start of a line
-        if multistart and multiend \
-           and any(line.lstrip().startswith(delim) or line.rstrip().endswith(delim)
-                   for delim in (multistart, multiend)):
+        if delimiters and (line.lstrip().startswith(delimiters) or line.rstrip().endswith(delimiters)):
             multi_line = not multi_line
+            stripped = line.strip()
 
             if multi_line \
-               and line.strip().endswith(multiend) \
-               and len(line.strip()) > len(multiend):
+               and stripped.endswith(multiend) \
+               and len(stripped) > len(multiend):
                 multi_line = False
 
-            if not line.strip().startswith(multistart) and not multi_line \
+            if not stripped.startswith(multistart) and not multi_line \
                or multi_string:
 
                 process_as_code = True
@@ -198,53 +461,83 @@ def parse(code, language):
                 # docs
                 line = line.replace(multistart, '')
                 line = line.replace(multiend, '')
-                docs_text += line.strip() + '\n'
-                indent_level = re.match("\s*", line).group(0)
+                stripped = line.strip()
+                docs.append(stripped + '\n')
+                docs_blank = docs_blank and not stripped
+                indent_length = indent_matcher.match(line).end()
+                indent = ' ' * indent_length
 
-                if has_code and docs_text.strip():
-                    save(docs_text, code_text[:-1])
-                    code_text = code_text.split('\n')[-1]
-                    has_code = docs_text = ''
+                if code_lines and not docs_blank:
+                    save("".join(docs), "\n".join(code_lines))
+                    docs, code_lines = [], []
+                    docs_blank, code_lead = True, ""
 
         elif multi_line:
             # Remove leading spaces
-            if re.match(r' {{{:d}}}'.format(len(indent_level)), line):
-                docs_text += line[len(indent_level):] + '\n'
-            else:
-                docs_text += line + '\n'
-
-        elif re.match(comment_matcher, line):
-            if has_code:
-                save(docs_text, code_text)
-                has_code = docs_text = code_text = ''
-            docs_text += re.sub(comment_matcher, "", line) + "\n"
+            if line.startswith(indent):
+                line = line[indent_length:]
+            docs.append(line + '\n')
+            docs_blank = docs_blank and not line.strip()
 
         else:
-            process_as_code = True
+            match = comment_matcher.match(line)
+            if match:
+                if code_lines:
+                    code_lines.append("")
+                    save("".join(docs), "\n".join(code_lines))
+                    docs, code_lines = [], []
+                    docs_blank, code_lead = True, ""
+                comment = line[match.end():]
+                docs.append(comment + "\n")
+                docs_blank = docs_blank and not comment.strip()
+            else:
+                process_as_code = True
 
         if process_as_code:
-            if code_text and any(line.lstrip().startswith(x)
-                                 for x in ['class ', 'def ', '@']):
-                if not code_text.lstrip().startswith("@"):
-                    save(docs_text, code_text)
-                    code_text = has_code = docs_text = ''
+            if code_lines and line.lstrip().startswith(section_starts):
+                if code_lead != "@":
+                    code_lines.append("")
+                    save("".join(docs), "\n".join(code_lines))
+                    docs, code_lines = [], []
+                    docs_blank, code_lead = True, ""
 
             # Split yamls on top level list elements
-            if code_text and language["name"] == 'yaml' and line.startswith('-'):
-                save(docs_text, code_text)
-                code_text = has_code = docs_text = ''
+            if code_lines and is_yaml and line.startswith('-'):
+                code_lines.append("")
+                save("".join(docs), "\n".join(code_lines))
+                docs, code_lines = [], []
+                docs_blank, code_lead = True, ""
 
-            has_code = True
-            code_text += line + '\n'
+            code_lines.append(line)
+            if not code_lead:
+                code_lead = line.lstrip()[:1]
 
-    save(docs_text, code_text)
+        if sections:
+            for section in sections:
+                yield section
+            del sections[:]
 
-    return sections
+    if code_lines:
+        code_lines.append("")
+    save("".join(docs), "\n".join(code_lines))
+
+    for section in sections:
+        yield section
 
 # === Preprocessing the comments ===
 
 
-def preprocess(comment, preserve_paths=True, outdir=None):
+# Patterns used by `preprocess`: section names written as `=== like this ===`,
+# and `[[cross-references]]` to other files.
+section_name_matcher = re.compile(r'^([=]+)([^=]+)[=]*\s*$')
+crossref_matcher = re.compile(r'(?<!`)\[\[(.+?)\]\]')
+
+
+def sanitize_section_name(name):
+    return "-".join(name.lower().strip().split(" "))
+
+
+def preprocess(comment, preserve_paths=True, outdir=None, xref=None):
     """
     Add cross-references before having the text processed by markdown.  It's
     possible to reference another file, like this : `[[main.py]]` which renders
@@ -253,15 +546,21 @@ def preprocess(comment, preserve_paths=True, outdir=None):
     [[main.py#highlighting-the-source-code]]. Sections have to be manually
     declared; they are written on a single line, and surrounded by equals signs:
     `=== like this ===`
+
+    With the `xref` index of a build, references are linked relative to the
+    page they are on, wherever their target is in the tree.
     """
 
     if not outdir:
         raise TypeError("Missing the required 'outdir' keyword argument.")
 
-    def sanitize_section_name(name):
-        return "-".join(name.lower().strip().split(" "))
-
     def replace_crossref(match):
+        if xref is not None:
+            name, _, anchor = match.group(1).partition('#')
+            href = xref.page(name, anchor)
+            if href is not None:
+                return " [{}]({})".format(name, href)
+
         # Check if the match contains an anchor
         if '#' in match.group(1):
             name, anchor = match.group(1).split('#')
@@ -282,66 +581,228 @@ def preprocess(comment, preserve_paths=True, outdir=None):
         Replace equals-sign-formatted section names with anchor links.
         """
         return '{lvl} <span id="{id}" href="{id}">{name}</span>'.format(
-            lvl=re.sub('=', '#', match.group(1)),
+            lvl=match.group(1).replace('=', '#'),
             id=sanitize_section_name(match.group(2)),
             name=match.group(2)
         )
 
-    comment = re.sub('^([=]+)([^=]+)[=]*\s*$', replace_section_name, comment)
-    comment = re.sub('(?<!`)\[\[(.+?)\]\]', replace_crossref, comment)
+    comment = section_name_matcher.sub(replace_section_name, comment)
+    comment = crossref_matcher.sub(replace_crossref, comment)
 
     return comment
 
 # === Highlighting the source code ===
 
-def highlight(sections, language, preserve_paths=True, outdir=None):
+def highlight(sections, language, preserve_paths=True, outdir=None, cache=None,
+              xref=None, code_html=None):
     """
     Highlights a single chunk of code using the **Pygments** module, and runs
     the text of its corresponding comment through **Markdown**.
 
-    We process the entire file in a single call to Pygments by inserting little
-    marker comments between each section and then splitting the result string
-    wherever our markers occur.
+    The code of every section is highlighted by `highlight_code` in a single
+    pass of the lexer over the file.
+
+    If a `cache` is given, sections whose text has been rendered before reuse
+    that HTML, and only the remaining ones go through Pygments and Markdown.
+    If the HTML of the code of every section is known already, as
+    `code_html`, only the comments are rendered.
     """
 
     if not outdir:
         raise TypeError("Missing the required 'outdir' keyword argument.")
 
-    output = pygments.highlight(language["divider_text"].join(section["code_text"].rstrip() for section in sections),
-                                language["lexer"],
-                                formatters.get_formatter_by_name("html"))
+    import markdown as markdown_module
+
+    # Markdown 2 exposes its version as `markdown.__version__.version`.
+    markdown_version = getattr(markdown_module.__version__, "version",
+                               markdown_module.__version__)
 
-    output = output.replace(highlight_start, "").replace(highlight_end, "")
-    fragments = re.split(language["divider_html"], output)
+    if code_html is not None:
+        for section, html in zip(sections, code_html):
+            section["code_html"] = html
+    else:
+        _highlight_sections(sections, language, cache)
+
+    with profiling.stage("markdown"):
+        _render_docs(sections, preserve_paths, outdir, cache, markdown_version,
+                     xref)
+
+    return sections
+
+
+def _highlight_sections(sections, language, cache):
+    """
+    Highlight the code of every section, reusing the HTML from `cache` where
+    there is one.
+    """
+    import pygments
+
+    with profiling.stage("highlight"):
+        pending = []
+        for section in sections:
+            key = None
+            if cache is not None:
+                key = cache.key("code", section["code_text"].rstrip(),
+                                language["name"], pygments.__version__)
+                section["code_html"] = cache.get(key)
+            if key is None or section["code_html"] is None:
+                pending.append((key, section))
+
+        fragments = highlight_code([section["code_text"] for _, section in pending],
+                                   language)
+        for (key, section), fragment in zip(pending, fragments):
+            section["code_html"] = highlight_start + fragment + highlight_end
+            if key is not None:
+                cache.set(key, section["code_html"])
+
+
+def _render_docs(sections, preserve_paths, outdir, cache, markdown_version,
+                 xref=None):
+    """
+    Run the comment of every section through `preprocess` and **Markdown**,
+    reusing the HTML from `cache` where there is one. The cache is keyed on
+    the preprocessed text, which has the links resolved for this page.
+    """
     for i, section in enumerate(sections):
-        section["code_html"] = highlight_start + \
-            shift(fragments, "") + highlight_end
         try:
             docs_text = unicode(section["docs_text"])
         except UnicodeError:
             docs_text = unicode(section["docs_text"].decode('utf-8'))
         except NameError:
             docs_text = section['docs_text']
-        section["docs_html"] = markdown(preprocess(docs_text,
-                                                   preserve_paths=preserve_paths,
-                                                   outdir=outdir))
+
+        docs_text = preprocess(docs_text, preserve_paths=preserve_paths,
+                               outdir=outdir, xref=xref)
+        docs_key = section["docs_html"] = None
+        if cache is not None:
+            docs_key = cache.key("docs", docs_text, markdown_version)
+            section["docs_html"] = cache.get(docs_key)
+        if section["docs_html"] is None:
+            section["docs_html"] = render_markdown(docs_text)
+            if docs_key is not None:
+                cache.set(docs_key, section["docs_html"])
         section["num"] = i
 
-    return sections
+
+# Comments rendered during this run, keyed on their preprocessed text, so that
+# license headers and other boilerplate repeated across files go through
+# Markdown only once.
+rendered_docs = LRUCache(4096)
+
+# One Markdown converter per thread, reset between comments rather than built
+# anew for each one.
+_markdown = threading.local()
+
+
+def render_markdown(text):
+    """
+    Run a (preprocessed) comment through **Markdown**.
+    """
+
+    html = rendered_docs.get(text)
+    if html is None:
+        converter = getattr(_markdown, "converter", None)
+        if converter is None:
+            import markdown
+            converter = _markdown.converter = markdown.Markdown()
+        html = rendered_docs[text] = converter.reset().convert(text)
+    return html
+
+
+def highlight_code(codes, language):
+    """
+    Highlight the code of a run of consecutive sections, returning the HTML
+    for each one.
+
+    The sections are joined into one text, one per line range, and lexed in a
+    single pass. The token stream is then cut wherever a section's lines end,
+    and each section's tokens are formatted on their own. Tokens that span
+    sections, like a long string, are split at the line break between them.
+    """
+
+    import pygments
+    from pygments.formatters import HtmlFormatter
+
+    if not codes:
+        return []
+
+    # Pygments turns every line ending into a newline, so do the same up
+    # front to count lines the way the lexer will see them. The blank lines
+    # at either end of a section are dropped, as they always have been. Each
+    # section is followed by exactly one newline, including the last one,
+    # which stops the lexer from adding a newline of its own.
+    codes = [code.replace("\r\n", "\n").replace("\r", "\n").lstrip("\n").rstrip()
+             for code in codes]
+    tokens = language["lexer"].get_tokens("\n".join(codes) + "\n")
+
+    # The formatter ends every line it writes with a newline, including the
+    # last one of each section, so take that back off.
+    formatter = HtmlFormatter(nowrap=True)
+    fragments = []
+    for section_tokens in split_tokens(tokens, codes):
+        fragment = pygments.format(section_tokens, formatter)
+        fragments.append(fragment[:-1] if fragment.endswith("\n") else fragment)
+    return fragments + [""] * (len(codes) - len(fragments))
+
+
+def split_tokens(tokens, codes):
+    """
+    Split a token stream for the `codes` of consecutive sections, each one
+    followed by a newline, into a list of tokens for each section. The
+    newline after each section is dropped.
+    """
+
+    # The number of newlines until the end of each section, counting the one
+    # that follows it.
+    remaining = [code.count("\n") + 1 for code in reversed(codes)]
+    section = []
+    for ttype, value in tokens:
+        while remaining:
+            newlines = value.count("\n")
+            if newlines < remaining[-1]:
+                remaining[-1] -= newlines
+                if value:
+                    section.append((ttype, value))
+                break
+
+            # The section ends inside this token: find the newline that
+            # closes it, and carry on with the rest of the token.
+            end = -1
+            for _ in range(remaining.pop()):
+                end = value.index("\n", end + 1)
+            if end:
+                section.append((ttype, value[:end]))
+            yield section
+            section = []
+            value = value[end + 1:]
+
 
 # === HTML Code generation ===
 
 
-def generate_html(source, sections, preserve_paths=True, outdir=None):
+def generate_html(source, sections, preserve_paths=True, outdir=None,
+                  search=False):
     """
     Once all of the code is finished highlighting, we can generate the HTML file
     and write out the documentation. Pass the completed sections into the
     template found in `resources/pycco.html`.
 
-    Pystache will attempt to recursively render context variables, so we must
-    replace any occurences of `{{`, which is valid in some languages, with a
-    "unique enough" identifier before rendering, and then post-process the
-    rendered template and change the identifier back to `{{`.
+    The template splices each section's HTML in as it is, rather than letting
+    Pystache render it, so any `{{` in the highlighted code (valid in some
+    languages) comes through untouched.
+
+    With `search`, the page gets a search box, which loads the search index
+    written by `process(search=True)`.
+    """
+
+    return u"".join(iter_html(source, sections, preserve_paths=preserve_paths,
+                              outdir=outdir, search=search)).encode("utf-8")
+
+
+def iter_html(source, sections, preserve_paths=True, outdir=None, search=False):
+    """
+    Render the page for `source` like `generate_html`, but piece by piece: the
+    page header, each section in turn, and the footer.
     """
 
     if not outdir:
@@ -350,22 +811,43 @@ def generate_html(source, sections, preserve_paths=True, outdir=None):
     dest = destination(source, preserve_paths=preserve_paths, outdir=outdir)
     csspath = path.relpath(path.join(outdir, "pycco.css"), path.split(dest)[0])
 
-    for sect in sections:
-        sect["code_html"] = re.sub(
-            r"\{\{", r"__DOUBLE_OPEN_STACHE__", sect["code_html"])
-
-    rendered = pycco_template({
+    return pycco_template.iter_render({
         "title": title,
         "stylesheet": csspath,
         "sections": sections,
         "source": source,
+        "search": search,
     })
 
-    return re.sub(r"__DOUBLE_OPEN_STACHE__", "{{", rendered).encode("utf-8")
-
 
 # === Helpers & Setup ===
 
+class Language(dict):
+    """
+    One of the languages in `languages`. The comment matcher and Pygments
+    lexer a language needs are built the first time they are looked up, so
+    that only the languages actually documented pay for them.
+    """
+
+    def __missing__(self, key):
+        if key == "comment_matcher":
+            # Does the line begin with a comment?
+            value = re.compile(r"^\s*" + self["symbol"] + r"\s?")
+
+        elif key == "lexer":
+            # Get the Pygments Lexer for this language. Leading and trailing
+            # newlines are kept, so that the lines of the lexed code match up
+            # with the lines of the sections.
+            from pygments import lexers
+            value = lexers.get_lexer_by_name(self["name"], stripnl=False)
+
+        else:
+            raise KeyError(key)
+
+        self[key] = value
+        return value
+
+
 # A list of the languages that Pycco supports, mapping the file extension to
 # the name of the Pygments lexer and the symbol that indicates a comment. To
 # add another language to Pycco's repertoire, add it here.
@@ -417,50 +899,126 @@ languages = {
     ".yml": {"name": "yaml", "symbol": "#"},
 }
 
-# Build out the appropriate matchers and delimiters for each language.
-for ext, l in languages.items():
-    # Does the line begin with a comment?
-    l["comment_matcher"] = re.compile(r"^\s*" + l["symbol"] + "\s?")
+# Wrap each entry so that its matchers and lexer are built on demand.
+languages = dict((ext, Language(l)) for ext, l in languages.items())
+
 
-    # The dividing token we feed into Pygments, to delimit the boundaries between
-    # sections.
-    l["divider_text"] = "\n" + l["symbol"] + "DIVIDER\n"
+# The same languages, by the name of their Pygments lexer.
+languages_by_name = {}
+for _language in languages.values():
+    languages_by_name.setdefault(_language["name"], _language)
+del _language
 
-    # The mirror of `divider_text` that we expect Pygments to return. We can split
-    # on this to recover the original sections.
-    l["divider_html"] = re.compile(
-        r'\n*<span class="c[1]?">' + l["symbol"] + 'DIVIDER</span>\n*')
+# Interpreters named on `#!` lines, for the languages that don't go by the
+# name of their interpreter.
+interpreters = {
+    "sh": "bash", "zsh": "bash", "ksh": "bash", "dash": "bash",
+    "node": "javascript", "nodejs": "javascript", "coffee": "coffee-script",
+    "escript": "erlang", "tclsh": "tcl", "wish": "tcl",
+    "runhaskell": "haskell", "runghc": "haskell", "guile": "scheme",
+}
 
-    # Get the Pygments Lexer for this language.
-    l["lexer"] = lexers.get_lexer_by_name(l["name"])
+# Only this many characters at the start of a file are looked at to work out
+# its language from its contents.
+GUESS_CHARS = 8192
 
+extension_matcher = re.compile(r'.*(\..+)')
+shebang_matcher = re.compile(r'#!\s*(\S+)(?:\s+(\S+))?')
+modeline_matchers = (
+    # Emacs: `-*- mode: python -*-` or `-*- python -*-`
+    re.compile(r'-\*-\s*(?:.*?\bmode:\s*)?([\w+-]+)\s*(?:;.*)?-\*-', re.I),
+    # Vim: `vim: set ft=python:` or `vi: filetype=python`
+    re.compile(r'\b(?:vim?|ex):.*?\b(?:ft|filetype|syntax)=([\w+-]+)'),
+)
 
-def get_language(source, code, language=None):
-    """Get the current language we're documenting, based on the extension."""
+# Languages worked out from the code of files without a known extension, by
+# path and a hash of the start of the file.
+detected_languages = LRUCache(4096)
 
+
+def _named_language(source, language=None):
+    """
+    The language forced with `language`, or given away by the extension of
+    `source`. None if only the code can tell.
+    """
     if language is not None:
-        for l in languages.values():
-            if l["name"] == language:
-                return l
-        else:
+        if isinstance(language, Language):
+            return language
+        try:
+            return languages_by_name[language]
+        except KeyError:
             raise ValueError("Unknown forced language: " + language)
 
-    m = re.match(r'.*(\..+)', os.path.basename(source)) if source else None
+    m = extension_matcher.match(os.path.basename(source)) if source else None
     if m and m.group(1) in languages:
         return languages[m.group(1)]
-    else:
-        try:
-            lang = lexers.guess_lexer(code).name.lower()
-            for l in languages.values():
-                if l["name"] == lang:
-                    return l
-            else:
-                raise ValueError()
-        except ValueError:
-            # If pygments can't find any lexers, it will raise its own
-            # subclass of ValueError. We will catch it and raise ours
-            # for consistency.
-            raise ValueError("Can't figure out the language!")
+    return None
+
+
+def _declared_language(head):
+    """
+    The language a file declares in its first few lines, with a `#!` line or
+    an editor modeline.
+    """
+    lines = head.split("\n", 5)[:5]
+    match = shebang_matcher.match(lines[0])
+    if match:
+        interpreter = path.basename(match.group(1))
+        if interpreter == "env" and match.group(2):
+            interpreter = match.group(2)
+        # `python3.8` is `python`.
+        interpreter = re.sub(r'[\d.]+$', '', interpreter)
+        name = interpreters.get(interpreter, interpreter)
+        if name in languages_by_name:
+            return languages_by_name[name]
+
+    for line in lines:
+        for matcher in modeline_matchers:
+            match = matcher.search(line)
+            if match:
+                name = match.group(1).lower()
+                name = interpreters.get(name, name)
+                if name in languages_by_name:
+                    return languages_by_name[name]
+    return None
+
+
+def get_language(source, code, language=None):
+    """
+    Get the current language we're documenting: the forced `language`, if
+    there is one, then the one the extension of `source` gives away, then
+    one declared by a `#!` line or modeline at the start of `code`. Pygments
+    only has to guess as a last resort, from the first `GUESS_CHARS`
+    characters of the code. What the code gave away is remembered, by path
+    and a hash of the code looked at.
+    """
+
+    named = _named_language(source, language)
+    if named is not None:
+        return named
+
+    import hashlib
+
+    head = code[:GUESS_CHARS]
+    key = (source, hashlib.sha1(head.encode("utf-8", "replace")).hexdigest())
+    detected = detected_languages.get(key)
+    if detected is None:
+        detected = _declared_language(head)
+        if detected is None:
+            from pygments import lexers
+            try:
+                lang = lexers.guess_lexer(head).name.lower()
+                detected = languages_by_name.get(lang, False)
+            except ValueError:
+                # If pygments can't find any lexers, it will raise its own
+                # subclass of ValueError.
+                detected = False
+        detected_languages[key] = detected
+
+    if detected is False:
+        # Raise our own ValueError for consistency.
+        raise ValueError("Can't figure out the language!")
+    return detected
 
 
 def destination(filepath, preserve_paths=True, outdir=None):
@@ -542,100 +1100,685 @@ def _flatten_sources(sources):
     return _sources
 
 
-def process(sources, preserve_paths=True, outdir=None, language=None, encoding="utf8", index=False, skip=False):
-    """For each source file passed as argument, generate the documentation."""
+def scan_references(sections, language):
+    """
+    Find the anchors, Service classes and references to other files in the
+    parsed `sections` of a file, for its entry in the cross-reference index.
+    References are `(kind, target)` pairs: `("page", "main.py#anchor")` for
+    `[[main.py#anchor]]`, and `("service", "module.Class")` for a YAML slice's
+    data service.
+    """
+    anchors, services, references = set(), [], []
+    for section in sections:
+        docs_text = section["docs_text"]
+        match = section_name_matcher.match(docs_text)
+        if match:
+            anchors.add(sanitize_section_name(match.group(2)))
+        references.extend(("page", m.group(1))
+                          for m in crossref_matcher.finditer(docs_text))
+
+        if language["name"] == "python":
+            match = service_matcher.match(section["code_text"])
+            if match:
+                services.append(match.group(1))
+                anchors.add(sanitize_section_name(match.group(1)))
+        elif language["name"] == "yaml":
+            match = data_service_matcher.search(section["code_text"])
+            if match and match.group(2) != "json":
+                references.append(("service", ".".join(match.groups())))
+    return anchors, services, references
+
+
+def build_references(sources, preserve_paths=True, outdir=None, language=None,
+                     encoding="utf8", saved=None, digests=None):
+    """
+    Build the cross-reference index of `sources` by parsing each of them, or
+    from the `saved` index entries of files that haven't changed. Files that
+    can't be read or have no known language are left out. The SHA-1 digest of
+    every file read is stored in the `digests` dict, if one is given.
+
+    Each file is read a line at a time and scanned a section at a time, so
+    only the section being parsed is ever in memory.
+    """
+    import hashlib
+
+    xref = CrossReferences()
+    saved = saved or {}
+    for source in sources:
+        entry = saved.get(source)
+        if entry is not None:
+            xref.add_page(source, entry["dest"], entry["anchors"],
+                          entry["services"],
+                          [tuple(reference) for reference in entry["references"]])
+            continue
+        digest = hashlib.sha1()
+        try:
+            with profiling.source_file(source):
+                code, source_language = _read_code(source, encoding, language,
+                                                   digest)
+                references = scan_references(iter_parse(code, source_language),
+                                             source_language)
+        except (IOError, OSError, UnicodeDecodeError, ValueError):
+            continue
+        if digests is not None:
+            digests[source] = digest.hexdigest()
+        dest = destination(source, preserve_paths=preserve_paths, outdir=outdir)
+        xref.add_page(source, dest, *references)
+    return xref
+
+
+# At most this many broken cross-references are listed one by one.
+BROKEN_LINKS_SHOWN = 20
+
+
+def _report_broken_links(xref, limit=BROKEN_LINKS_SHOWN):
+    """
+    Report the cross-references of a build that lead nowhere on stderr,
+    listing the first `limit` of them.
+    """
+    broken = xref.broken()
+    for source, target in broken[:limit]:
+        print("pycco [BROKEN LINK]: {}: {}".format(source, target),
+              file=sys.stderr)
+    if len(broken) > limit:
+        print("pycco [BROKEN LINK]: ... and {} more".format(
+            len(broken) - limit), file=sys.stderr)
+    if broken:
+        print("pycco: {} broken cross-reference{}".format(
+            len(broken), "" if len(broken) == 1 else "s"), file=sys.stderr)
+
+
+# The section cache of a pool worker, its cross-reference index, and the
+# recorder of its stage timings, set up by `_init_worker`.
+_worker_cache = None
+_worker_xref = None
+_worker_recorder = None
+
+
+def _init_worker(cache=None, warm=(), record=False, xref=None):
+    """
+    Initializer for the worker processes of a parallel build. Make sure the
+    lexers of the languages with `warm` extensions are built before the
+    worker picks up its first file. With `record`, stage timings are kept to
+    be sent back to the parent, whose callbacks don't run in the worker.
+    """
+    global _worker_cache, _worker_xref, _worker_recorder
+    _worker_cache = cache
+    _worker_xref = xref
+    if record:
+        profiling.clear()
+        _worker_recorder = profiling.register(profiling.Recorder())
+    for ext in warm:
+        languages[ext]["lexer"]
+
+
+# Sources bigger than this many bytes aren't read ahead by the I/O threads of a
+# build, but a line at a time as they are rendered.
+PREFETCH_SIZE = 1 << 20
+
+
+def _read_source(source, encoding="utf8", limit=PREFETCH_SIZE):
+    """
+    Read and decode `source`, on one of the I/O threads of a build. Returns
+    the code, a decoding error in its place rather than raised, and the stat
+    and SHA-1 digest of what was read. A file of more than `limit` bytes is
+    left alone, and all four are None.
+    """
+    import hashlib
+
+    with profiling.stage("read", source):
+        stat = os.stat(source)
+        if stat.st_size > limit:
+            return None, None, None, None
+        with open(source, "rb") as f:
+            raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    try:
+        return raw.decode(encoding), None, stat, digest
+    except UnicodeDecodeError as e:
+        return None, e, stat, digest
+
+
+# How many chunks of a page can wait for the I/O thread that writes it.
+STREAM_DEPTH = 64
+
+
+def _write_page(source, dest, stream):
+    """
+    Write a page to `dest` as it is rendered on another thread, from the
+    `pipeline.Stream` of its chunks, on one of the I/O threads of a build.
+    Returns whether `dest` was replaced: never if the page was cut short.
+    """
+    with profiling.source_file(source):
+        try:
+            return _write_chunks(dest, stream)
+        except pipeline.Aborted:
+            # Whatever stopped the page is reported along with its render.
+            return False
+        except BaseException:
+            stream.discard()
+            raise
+
+
+def _render_file(job, cache=None, xref=None, code=None, duplicates=None,
+                 stream=None):
+    """
+    Render a single source file, possibly inside a pool worker, and stream
+    the page into its destination as it is rendered, or into the `stream` an
+    I/O thread writes it from. If the source has been read already, its
+    `code` is passed in as returned by `_read_source`; otherwise it is read
+    as it is rendered. Decoding errors are handed back to the caller, which
+    decides whether to skip or raise them, along with any entries added to
+    the section cache, the stage timings recorded in a worker, whether the
+    page changed (None when it is left to the `stream`), and the stat and
+    digest of the source the page was rendered from, for the manifest.
+
+    If the job names a profile path, the file is rendered under cProfile and
+    the statistics are dumped there.
+    """
+    source, dest, options, profile_path = job
+    if cache is None:
+        cache = _worker_cache
+    if xref is None:
+        xref = _worker_xref
+
+    def render():
+        text, error, stat, digest = code if code is not None else (None,) * 4
+        if error is not None:
+            raise error
+        with profiling.source_file(source):
+            language, lazy = options["language"], text is None
+            if lazy:
+                import hashlib
+
+                stat, digest = os.stat(source), hashlib.sha1()
+                text, language = _read_code(source, options["encoding"],
+                                            language, digest)
+            chunks = _iter_documentation(
+                source, text, options["outdir"], options["preserve_paths"],
+                language, cache=cache, xref=xref, duplicates=duplicates,
+                search=options["search"])
+            written = None
+            if stream is None:
+                written = _write_chunks(dest, chunks)
+            else:
+                for chunk in chunks:
+                    stream.put(chunk)
+            if lazy:
+                # A copy of an earlier file is rendered from that file's
+                # sections without being read: read the rest of it all the
+                # same, for its digest.
+                for _ in text:
+                    pass
+                digest = digest.hexdigest()
+        return written, stat, digest
+
+    written = error = read = None
+    complete = False
+    try:
+        try:
+            if profile_path is None:
+                written, stat, digest = render()
+            else:
+                import cProfile
+                profiler = cProfile.Profile()
+                try:
+                    written, stat, digest = profiler.runcall(render)
+                finally:
+                    ensure_directory(path.dirname(profile_path))
+                    profiler.dump_stats(profile_path)
+            complete, read = True, (stat, digest)
+        except UnicodeDecodeError as e:
+            error = e
+    finally:
+        if stream is not None:
+            stream.close(complete)
+    added = cache.take_added() if cache is not None else {}
+    timings = _worker_recorder.take() if _worker_recorder is not None else []
+    return source, error, added, timings, written, read
+
+
+def _profile_path(source, outdir, patterns):
+    """
+    Where to save the cProfile statistics for `source`, if it matches one of
+    `patterns`, either by its path or by its file name.
+    """
+    import fnmatch
+
+    for pattern in patterns:
+        if fnmatch.fnmatch(source, pattern) or \
+           fnmatch.fnmatch(path.basename(source), pattern):
+            name = source.strip(os.sep).replace(os.sep, "_")
+            return path.join(outdir, ".pycco-profile", name + ".prof")
+    return None
+
+
+def _print_progress(done, total, source, dest, status):
+    """
+    The default `progress` callback of `process()`: report every page that was
+    written, and every file that had to be skipped.
+    """
+    if status == "generated":
+        print("pycco: {} -> {}".format(source, dest))
+    elif status == "failed":
+        print("pycco [FAILURE]: {}".format(source))
+
+
+def process(sources, preserve_paths=True, outdir=None, language=None,
+            encoding="utf8", index=False, skip=False, jobs=1, force=False,
+            progress=_print_progress, profile_files=(), css=True,
+            index_page_size=None, search=False, io_threads=4,
+            compress=False, cache_dir=None):
+    """
+    For each source file passed as argument, generate the documentation.
+
+    Files are handled one at a time, in sorted order, by a plain loop, so any
+    number of sources can be documented in a single run. After each file,
+    `progress(done, total, source, dest, status)` is called, with `status`
+    one of `"generated"`, `"unchanged"` or `"failed"`.
+
+    With `jobs` greater than one, files are rendered by a pool of that many
+    worker processes (`0` means one per CPU). Results are still written, and
+    reported, in the same order as a serial run.
+
+    In a build without worker processes, files with the same contents are
+    parsed and highlighted only once.
+
+    Reading sources and writing pages is done by `io_threads` threads, so
+    that waiting on the disk overlaps with rendering. Only a few small files
+    are read ahead at any time, and each page goes to the thread that writes
+    it a few sections at a time, as it is rendered. With no I/O threads, or
+    with worker processes, each page is streamed into its file as it is
+    rendered, by whoever renders it.
+
+    Sources that haven't changed since they were last built into `outdir`,
+    with the same settings, are skipped unless `force` is set.
+
+    The HTML of every section rendered is cached in `cache_dir`, by default
+    `default_cache_dir()`, and reused wherever the same section comes up
+    again. With `force`, the saved cache is ignored.
+
+    Sources matching one of the `profile_files` patterns are rendered under
+    cProfile, and their statistics saved in `outdir/.pycco-profile`.
+
+    `pycco.css` is written to `outdir` unless `css` is false.
+
+    Output files are only written if their contents change, and then through
+    a temporary file renamed over the old one. The number of files written is
+    returned.
+
+    With `compress`, a `.gz` copy of every page, of `pycco.css` and of the
+    index is written next to it, plus a `.br` copy if `brotli` is installed.
+    The copies are made by a pool of threads, and only for the files that
+    changed since they were last compressed.
+
+    With `index`, an `index.html` listing every page is written too. Given an
+    `index_page_size`, the index is split into one paginated index for each
+    directory instead, and only those whose contents changed are rewritten.
+
+    With `search`, a search index of every page, section and Service class is
+    written to `outdir/search` for the search box of the pages.
+    """
 
     if not outdir:
         raise TypeError("Missing the required 'directory' keyword argument.")
 
     # Make a copy of sources given on the command line. `main()` needs the
     # original list when monitoring for changed files.
-    sources = sorted(_flatten_sources(sources))
+    sources = sorted(set(_flatten_sources(sources)))
 
     # Proceed to generating the documentation.
+    changed = 0
     if sources:
         outdir = ensure_directory(outdir)
-        css = open(path.join(outdir, "pycco.css"), "wb")
-        css.write(pycco_css.encode(encoding))
-        css.close()
+        if css:
+            changed += files.write_if_changed(path.join(outdir, "pycco.css"),
+                                              pycco_css.encode(encoding))
 
         generated_files = []
+        dests = [destination(s, preserve_paths=preserve_paths, outdir=outdir)
+                 for s in sources]
+
+        manifest = Manifest.load(outdir, build_settings(
+            preserve_paths=bool(preserve_paths), language=language,
+            encoding=encoding, search=bool(search)))
+        stale = [force or not manifest.is_fresh(s, dest)
+                 for s, dest in zip(sources, dests)]
+
+        # Links between pages are resolved through an index of every file,
+        # built before anything is rendered. Unchanged files are indexed from
+        # the manifest, and their pages only rebuilt if one of their links
+        # now leads somewhere else.
+        digests = {}
+        xref = build_references(
+            sources, preserve_paths=preserve_paths, outdir=outdir,
+            language=language, encoding=encoding,
+            saved=dict((s, manifest.references(s))
+                       for s, is_stale in zip(sources, stale)
+                       if not is_stale and manifest.references(s)),
+            digests=digests)
+        stale = [is_stale or s not in xref.sources or manifest.entries[s].get("links") != xref.links(s)
+                 for s, is_stale in zip(sources, stale)]
+        if progress is not None and any(stale):
+            _report_broken_links(xref)
+
+        cache = SectionCache(cache_dir or default_cache_dir(), fresh=force)
+
+        def record_file(s, dest, write_error, error, added, timings, read):
+            cache.update(added)
+            for timing in timings:
+                profiling.report(*timing)
 
-        def next_file():
-            s = sources.pop(0)
-            dest = destination(s, preserve_paths=preserve_paths, outdir=outdir)
+            try:
+                if error is not None:
+                    raise error
+                if write_error is not None:
+                    raise write_error
 
+                generated_files.append(dest)
+                stat, digest = read
+                if digests.get(s, digest) == digest:
+                    manifest.record(s, dest, xref.describe(s)
+                                    if s in xref.sources else None,
+                                    stat, digest)
+                else:
+                    # The file changed after it was indexed: build it again
+                    # next time, along with its links.
+                    manifest.forget(s)
+                return "generated"
+            except UnicodeDecodeError:
+                manifest.forget(s)
+                if skip:
+                    return "failed"
+                raise
+
+        options = dict(preserve_paths=preserve_paths, outdir=outdir,
+                       language=language, encoding=encoding, search=search)
+        pending = [(s, dest) for s, dest, is_stale in zip(sources, dests, stale)
+                   if is_stale]
+        jobs_list = [(s, dest, options, _profile_path(s, outdir, profile_files))
+                     for s, dest in pending]
+
+        # Identical files are only parsed and highlighted once. Files that
+        # weren't read above are unchanged, and the manifest has their hash.
+        for s, _ in pending:
+            if s not in digests and s in manifest.entries:
+                digests[s] = manifest.entries[s]["digest"]
+        duplicates = Duplicates(dict((s, digests[s]) for s, _ in pending
+                                     if s in digests))
+
+        for _, dest in pending:
             try:
                 os.makedirs(path.split(dest)[0])
             except OSError:
                 pass
 
-            try:
-                with open(dest, "wb") as f:
-                    f.write(generate_documentation(s, preserve_paths=preserve_paths,
-                                                   outdir=outdir,
-                                                   language=language,
-                                                   encoding=encoding))
+        pool = io_pool = codes = None
+        depth = max(2, 4 * (io_threads or 0))
+        if jobs is not None and jobs != 1 and len(jobs_list) > 1:
+            import multiprocessing
 
-                print("pycco: {} -> {}".format(s, dest))
+            # Build the lexers every worker is going to need up front, so
+            # forked workers inherit them rather than each building their own.
+            if language is not None:
+                warm = [ext for ext, l in languages.items()
+                        if l["name"] == language][:1]
+            else:
+                warm = set(path.splitext(s)[1] for s, _ in pending)
+                warm = sorted(ext for ext in warm if ext in languages)
+            _init_worker(warm=warm)
+            pool = multiprocessing.Pool(jobs or None, _init_worker,
+                                        (cache, warm, profiling.enabled(), xref))
+
+            # Hand out files in small batches to keep the overhead of talking
+            # to the workers down on very large trees.
+            workers = jobs or multiprocessing.cpu_count()
+            chunksize = max(1, min(16, len(jobs_list) // (workers * 8)))
+            results = pool.imap(_render_file, jobs_list, chunksize)
+        elif io_threads and len(pending) > 1:
+            from multiprocessing.pool import ThreadPool
+
+            # Sources are read ahead while the current one is rendered, and
+            # each page is written by an I/O thread as it is rendered. Worker
+            # processes write their own pages, and don't need the threads.
+            io_pool = ThreadPool(io_threads)
+            codes = pipeline.prefetch(
+                io_pool, functools.partial(_read_source, encoding=encoding,
+                                           limit=PREFETCH_SIZE),
+                [s for s, _ in pending], depth)
+            jobs_iter = iter(jobs_list)
+        else:
+            # Otherwise a serial build streams each page straight into its
+            # destination.
+            results = (_render_file(job, cache, xref=xref,
+                                    duplicates=duplicates)
+                       for job in jobs_list)
+
+        total = len(sources)
+        counts = [0]
+
+        def finish(tag, write_error, written):
+            done, s, dest, result = tag
+            if result is None:
                 generated_files.append(dest)
-            except UnicodeDecodeError:
-                if skip:
-                    print("pycco [FAILURE]: {}".format(s))
-                else:
-                    raise
-
-            if sources:
-                next_file()
-        next_file()
+                status = "unchanged"
+            else:
+                status = record_file(s, dest, write_error, *result[1:4],
+                                     read=result[5])
+                if written is None:
+                    written = result[4]
+            if written:
+                counts[0] += 1
+            if progress is not None:
+                progress(done, total, s, dest, status)
+
+        # Pages are written behind the rendering, and reported in order once
+        # they are on disk.
+        writer = pipeline.WriteBehind(io_pool, finish, depth)
+        try:
+            for done, (s, dest, is_stale) in enumerate(zip(sources, dests, stale), 1):
+                if not is_stale:
+                    writer.submit(None, (), (done, s, dest, None))
+                    continue
+                if codes is None:
+                    writer.submit(None, (), (done, s, dest, next(results)))
+                    continue
+                # The write starts first, and the result of the render is
+                # filled in once the whole page has gone to it.
+                job, code = next(jobs_iter), next(codes)
+                stream = pipeline.Stream(STREAM_DEPTH)
+                tag = [done, s, dest, None]
+                writer.submit(_write_page, (s, dest, stream), tag)
+                tag[3] = _render_file(job, cache, xref=xref, code=code,
+                                      duplicates=duplicates, stream=stream)
+            writer.drain()
+        finally:
+            if io_pool is not None:
+                io_pool.close()
+                io_pool.join()
+            manifest.save()
+            cache.save()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        changed += counts[0]
+        if search:
+            from pycco.search import write_search_index
+            changed += len(write_search_index(xref, outdir))
+
+        # Compressed copies are made on their own threads, once every page
+        # is on disk.
+        copies = None
+        if compress:
+            from multiprocessing.pool import ThreadPool
+            from pycco.compress import CompressedCopies, available_formats
+            copies = CompressedCopies.load(outdir, available_formats(),
+                                           ThreadPool())
+        try:
+            if copies is not None:
+                outputs = list(generated_files)
+                if css:
+                    outputs.append(path.join(outdir, "pycco.css"))
+                copies.compress(outputs)
+            if index:
+                changed += write_index(generated_files, outdir, index_page_size,
+                                       copies)
+        finally:
+            if copies is not None:
+                copies.pool.close()
+                copies.pool.join()
+                copies.save()
+    return changed
+
+
+def write_index(generated_files, outdir, index_page_size=None, compress=None):
+    """
+    Write the index of `generated_files`: a single `index.html`, or with an
+    `index_page_size`, one paginated index per directory. Returns the number
+    of index pages that changed. Given the `CompressedCopies` of `outdir` as
+    `compress`, the copies of the index pages are brought up to date too.
+    """
+    if index_page_size:
+        return len(generate_index.write_sharded_index(
+            generated_files, outdir, index_page_size, compress))
+    index_path = path.join(outdir, "index.html")
+    changed = files.write_if_changed(
+        index_path, generate_index.generate_index(generated_files, outdir))
+    if compress is not None:
+        compress.compress([index_path])
+    return int(changed)
 
-        if index:
-            with open(path.join(outdir, "index.html"), "wb") as f:
-                f.write(generate_index.generate_index(generated_files, outdir))
 
 __all__ = ("process", "generate_documentation")
 
 
-def monitor(sources, opts):
-    """Monitor each source file and re-generate documentation on change."""
+def _is_inside(filepath, directory):
+    filepath = path.abspath(filepath)
+    directory = path.abspath(directory)
+    return filepath == directory or filepath.startswith(directory + os.sep)
+
+
+def update_documentation(sources, changed, known, outdir, preserve_paths=True,
+                         language=None, encoding="utf8", index=False,
+                         skip=False, jobs=1, index_page_size=None,
+                         search=False, compress=False, cache_dir=None):
+    """
+    Bring the documentation of `sources`, which may include directories, up
+    to date after the files at the absolute paths in `changed` were created,
+    modified, moved or deleted. `known` is the set of files documented so
+    far, and the new set is returned.
+
+    Each changed file is rebuilt once; pages of files that are gone are
+    removed. `pycco.css` is left alone, and the index is only written again
+    when files have come or gone.
+    """
+    current = set(s for s in _flatten_sources(sources)
+                  if not _is_inside(s, outdir))
+    added = current - known
+    deleted = known - current
+    modified = set(s for s in current & known if path.abspath(s) in changed)
+
+    settings = dict(preserve_paths=preserve_paths, language=language,
+                    encoding=encoding)
+    if deleted:
+        from pycco.compress import remove_compressed
+        manifest = Manifest.load(outdir, build_settings(
+            preserve_paths=bool(preserve_paths), language=language,
+            encoding=encoding, search=bool(search)))
+        for s in sorted(deleted):
+            dest = destination(s, preserve_paths=preserve_paths, outdir=outdir)
+            try:
+                os.remove(dest)
+                print("pycco: removed {}".format(dest))
+            except OSError:
+                pass
+            remove_compressed(dest)
+            manifest.forget(s)
+        manifest.save()
+
+    # Every file is passed on, so that links to and from the changed ones are
+    # resolved against the whole tree; unaffected pages are left alone.
+    if added or modified or deleted:
+        process(sorted(current), outdir=outdir, skip=skip, jobs=jobs,
+                css=False, search=search, compress=compress,
+                cache_dir=cache_dir, **settings)
+
+    if index and (added or deleted):
+        generated_files = [destination(s, preserve_paths=preserve_paths,
+                                       outdir=outdir) for s in sorted(current)]
+        copies = None
+        if compress:
+            from pycco.compress import CompressedCopies, available_formats
+            copies = CompressedCopies.load(outdir, available_formats())
+        write_index(generated_files, outdir, index_page_size, copies)
+        if copies is not None:
+            copies.save()
+
+    return current
+
+
+def monitor(sources, opts, window=0.2):
+    """
+    Monitor the source files, and everything under the source directories,
+    and keep their documentation up to date. Events are collected until
+    none has come in for `window` seconds, and then handled in one batch.
+    """
 
     # The watchdog modules are imported in `main()` but we need to re-import
     # here to bring them into the local namespace.
     import watchdog.events
     import watchdog.observers
+    from pycco.watch import ChangeBatcher
 
-    # Watchdog operates on absolute paths, so map those to original paths
-    # as specified on the command line.
-    absolute_sources = dict((os.path.abspath(source), source)
-                            for source in sources)
+    outdir = opts.outdir or "."
+    options = dict(outdir=outdir, preserve_paths=opts.paths,
+                   language=opts.language,
+                   index=opts.generate_index or bool(opts.index_page_size),
+                   index_page_size=opts.index_page_size, search=opts.search,
+                   skip=opts.skip_bad_files, jobs=opts.jobs,
+                   compress=opts.compress, cache_dir=opts.cache_dir)
+    batcher = ChangeBatcher(window)
 
     class RegenerateHandler(watchdog.events.FileSystemEventHandler):
 
-        """A handler for recompiling files which triggered watchdog events"""
+        """A handler that collects the paths touched by watchdog events"""
 
-        def on_modified(self, event):
-            """Regenerate documentation for a file which triggered an event"""
-            # Re-generate documentation from a source file if it was listed on
-            # the command line. Watchdog monitors whole directories, so other
-            # files may cause notifications as well.
-            if event.src_path in absolute_sources:
-                process([absolute_sources[event.src_path]],
-                        outdir=opts.outdir,
-                        preserve_paths=opts.paths)
+        def on_any_event(self, event):
+            paths = [event.src_path, getattr(event, "dest_path", None)]
+            paths = [path.abspath(p) for p in paths
+                     if p and not _is_inside(p, outdir)]
+            if paths:
+                batcher.add(*paths)
 
-    # Set up an observer which monitors all directories for files given on
-    # the command line and notifies the handler defined above.
+    # Directories are watched with everything beneath them, single files
+    # through the directory they are in.
     event_handler = RegenerateHandler()
     observer = watchdog.observers.Observer()
-    directories = set(os.path.split(source)[0] for source in sources)
-    for directory in directories:
-        observer.schedule(event_handler, path=directory)
+    watches = {}
+    for source in sources:
+        if os.path.isdir(source):
+            watches[path.abspath(source)] = True
+        else:
+            directory = path.dirname(path.abspath(source))
+            watches.setdefault(directory, False)
+    for directory, recursive in sorted(watches.items()):
+        observer.schedule(event_handler, path=directory, recursive=recursive)
+
+    known = set(s for s in _flatten_sources(sources)
+                if not _is_inside(s, outdir))
 
     # Run the file change monitoring loop until the user hits Ctrl-C.
     observer.start()
     try:
         while True:
-            time.sleep(1)
+            changed = batcher.wait(1)
+            if not changed:
+                continue
+            try:
+                known = update_documentation(sources, changed, known, **options)
+            except Exception as e:
+                print("pycco [FAILURE]: {}".format(e))
     except KeyboardInterrupt:
         observer.stop()
         observer.join()
@@ -662,19 +1805,81 @@ def main():
     parser.add_option('-i', '--generate_index', action='store_true',
                       help='Generate an index.html document with sitemap content')
 
+    parser.add_option('--index-page-size', action='store', type='int',
+                      dest='index_page_size', default=None, metavar='N',
+                      help='Generate an index per directory, N entries per page')
+
+    parser.add_option('--search', action='store_true',
+                      help='Generate a search index for the search box of every page')
+
+    parser.add_option('--compress', action='store_true',
+                      help='Also write .gz copies of the output, and .br copies '
+                           'if brotli is installed')
+
     parser.add_option('-s', '--skip-bad-files', action='store_true',
                       dest='skip_bad_files',
                       help='Continue processing after hitting a bad file')
 
+    parser.add_option('-j', '--jobs', action='store', type='int',
+                      dest='jobs', default=1,
+                      help='Render files in N parallel processes (0 for one per CPU)')
+
+    parser.add_option('-f', '--force', action='store_true',
+                      help='Regenerate every file, even if it has not changed')
+
+    parser.add_option('--cache-dir', action='store', type='string',
+                      dest='cache_dir', default=None, metavar='DIR',
+                      help='Keep the cache of rendered sections in DIR '
+                           '(default: ~/.cache/pycco)')
+
+    parser.add_option('--profile', action='store_true',
+                      help='Time every stage of every file and report the slowest')
+
+    parser.add_option('--profile-file', action='append', type='string',
+                      dest='profile_files', default=[], metavar='PATTERN',
+                      help='Save cProfile statistics for files matching PATTERN')
+
+    parser.add_option('--daemon', action='store', type='string',
+                      metavar='SOCKET',
+                      help='Serve render requests on the Unix socket SOCKET')
+
+    parser.add_option('--serve', action='store_true',
+                      help='Serve the documentation over HTTP, rendering pages on request')
+
+    parser.add_option('--port', action='store', type='int', default=8000,
+                      help='The port for --serve to listen on')
+
     opts, sources = parser.parse_args()
+    if opts.daemon:
+        from pycco.daemon import serve
+        serve(opts.daemon)
+        return
+    if opts.serve:
+        from pycco.serve import serve
+        serve(sources, outdir=opts.outdir or '.', preserve_paths=opts.paths,
+              language=opts.language, port=opts.port)
+        return
+
     if opts.outdir == '':
         outdir = '.'
     else:
         outdir = opts.outdir
 
-    process(sources, outdir=outdir, preserve_paths=opts.paths,
-            language=opts.language, index=opts.generate_index,
-            skip=opts.skip_bad_files)
+    if opts.profile:
+        profile = profiling.register(profiling.Profile())
+
+    changed = process(sources, outdir=outdir, preserve_paths=opts.paths,
+                      language=opts.language,
+                      index=opts.generate_index or bool(opts.index_page_size),
+                      index_page_size=opts.index_page_size, search=opts.search,
+                      skip=opts.skip_bad_files, jobs=opts.jobs,
+                      force=opts.force, profile_files=opts.profile_files,
+                      compress=opts.compress, cache_dir=opts.cache_dir)
+    print("pycco: {} file{} changed".format(changed, "" if changed == 1 else "s"))
+
+    if opts.profile:
+        profiling.unregister(profile)
+        print(profile.summary())
 
     # If the -w / --watch option was present, monitor the source directories
     # for changes and re-generate documentation for source files whenever they
@@ -0,0 +1,141 @@
+"""
+This module keeps track of what every generated page was built from. A small
+JSON manifest is saved in the output directory, recording the size, mtime and
+content hash of each source together with the settings of the build. A later
+run with the same settings can then skip any source that hasn't changed.
+
+Each entry also keeps what the source contributes to the cross-reference
+index, and where the links on its page led, so that a page can be rebuilt
+when a change to another file moves one of its links.
+"""
+import hashlib
+import json
+import os
+from os import path
+
+from pycco.files import write_if_changed
+from pycco_resources import css, html
+
+
+__all__ = ('Manifest', 'file_digest')
+
+# Name of the manifest file, relative to the output directory.
+MANIFEST_NAME = '.pycco-manifest'
+
+# Bump this whenever a change to Pycco alters the pages it generates, so that
+# documentation built by an older version is regenerated.
+MANIFEST_VERSION = 3
+
+
+def file_digest(file_path, chunk_size=1 << 16):
+    """
+    Return the SHA-1 hex digest of the contents of `file_path`.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_settings(**options):
+    """
+    Describe a build: the options that change the output of every page, plus
+    a hash of the template and stylesheet they are rendered with.
+    """
+    resources = hashlib.sha1((html + css).encode('utf-8')).hexdigest()
+    settings = dict(options, version=MANIFEST_VERSION, resources=resources)
+    # Round-trip through JSON so the settings compare equal to a loaded copy.
+    return json.loads(json.dumps(settings, sort_keys=True))
+
+
+class Manifest(object):
+    """
+    The record of every source built into an output directory.
+    """
+
+    def __init__(self, outdir, settings):
+        self.path = path.join(outdir, MANIFEST_NAME)
+        self.settings = settings
+        self.entries = {}
+
+    @classmethod
+    def load(cls, outdir, settings):
+        """
+        Read the manifest saved in `outdir`. Entries written with different
+        settings, or by a different version of Pycco, are discarded.
+        """
+        manifest = cls(outdir, settings)
+        try:
+            with open(manifest.path, 'rb') as f:
+                saved = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return manifest
+
+        if isinstance(saved, dict) and saved.get('settings') == settings:
+            manifest.entries = saved.get('files', {})
+        return manifest
+
+    def is_fresh(self, source, dest):
+        """
+        Is the page at `dest` up to date with `source`? A matching size and
+        mtime is trusted outright; otherwise the contents are hashed, so that
+        a touched but unchanged file is not rebuilt either.
+        """
+        entry = self.entries.get(source)
+        if not entry or entry['dest'] != dest or not path.exists(dest):
+            return False
+
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return False
+
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime != entry['mtime']:
+            if file_digest(source) != entry['digest']:
+                return False
+            entry['mtime'] = stat.st_mtime
+        return True
+
+    def record(self, source, dest, references=None, stat=None, digest=None):
+        """
+        Remember that `dest` was just built from `source`, with the
+        `references` its cross-reference index entry describes. The `stat`
+        taken before the source was read, and the `digest` of the bytes that
+        were read, describe what the page was built from; without them, the
+        file is looked at again.
+        """
+        if stat is None or digest is None:
+            stat, digest = os.stat(source), file_digest(source)
+        entry = dict(references or {})
+        entry.update({
+            'dest': dest,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'digest': digest,
+        })
+        self.entries[source] = entry
+
+    def references(self, source):
+        """
+        The cross-reference index entry saved for `source`, if there is one.
+        """
+        entry = self.entries.get(source)
+        if entry is None or 'anchors' not in entry:
+            return None
+        return entry
+
+    def forget(self, source):
+        self.entries.pop(source, None)
+
+    def save(self):
+        """
+        Write the manifest back to the output directory. The file is replaced
+        atomically, so an interrupted build never leaves a truncated manifest,
+        and only if anything in it changed.
+        """
+        data = json.dumps({'settings': self.settings, 'files': self.entries},
+                          sort_keys=True, indent=1).encode('utf-8')
+        write_if_changed(self.path, data)
@@ -0,0 +1,131 @@
+"""
+Helpers for overlapping the file I/O of a build with its CPU work. Sources
+are read ahead, and pages written behind, on a small pool of threads, while
+the main thread renders. Both directions are bounded: only a few sources are
+read ahead, and a page goes to the thread that writes it through a `Stream`
+of a few chunks at a time, as it is rendered.
+"""
+from collections import deque
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+__all__ = ('prefetch', 'WriteBehind', 'Stream', 'Aborted')
+
+
+def prefetch(pool, function, items, depth):
+    """
+    Yield `function(item)` for each of `items`, in order, with up to `depth`
+    calls running ahead of the consumer on the thread `pool`. Exceptions are
+    raised when their result is reached.
+    """
+    window = deque()
+    for item in items:
+        window.append(pool.apply_async(function, (item,)))
+        if len(window) >= depth:
+            yield window.popleft().get()
+    while window:
+        yield window.popleft().get()
+
+
+class WriteBehind(object):
+    """
+    Run writes on the thread `pool`, and call `finish(tag, error, value)` for
+    each once it is done, in the order the writes were submitted, with the
+    value the write returned. At most `depth` writes are in flight; submitting
+    another waits for the oldest. Without a pool, writes are done as they are
+    submitted.
+    """
+
+    def __init__(self, pool, finish, depth):
+        self.pool = pool
+        self.finish = finish
+        self.depth = depth
+        self.window = deque()
+
+    def submit(self, function, args, tag):
+        """
+        Run `function(*args)`, if there is a function, and finish `tag`.
+        """
+        pending = value = error = None
+        if function is not None:
+            if self.pool is not None:
+                pending = self.pool.apply_async(function, args)
+            else:
+                try:
+                    value = function(*args)
+                except Exception as e:
+                    error = e
+        self.window.append((pending, value, error, tag))
+        while len(self.window) > self.depth:
+            self._finish_oldest()
+
+    def _finish_oldest(self):
+        pending, value, error, tag = self.window.popleft()
+        if pending is not None:
+            try:
+                value = pending.get()
+            except Exception as e:
+                error = e
+        self.finish(tag, error, value)
+
+    def drain(self):
+        """
+        Wait for every write still in flight.
+        """
+        while self.window:
+            self._finish_oldest()
+
+
+class Aborted(Exception):
+    """
+    Raised by a `Stream` whose page was cut short by an error.
+    """
+
+
+class Stream(object):
+    """
+    The chunks of a page, passed from the thread that renders it to the one
+    that writes it. Once `depth` chunks are waiting, `put` waits for the
+    writer to catch up.
+    """
+
+    def __init__(self, depth):
+        self.queue = Queue(depth)
+        self.complete = self.closed = False
+
+    def put(self, chunk):
+        self.queue.put(chunk)
+
+    def close(self, complete=True):
+        """
+        Mark the end of the page, which is only `complete` if nothing went
+        wrong while rendering it.
+        """
+        self.complete = complete
+        self.queue.put(None)
+
+    def __iter__(self):
+        """
+        Yield the chunks as they come, until the page is closed. Raises
+        `Aborted` at the end of an incomplete page.
+        """
+        while not self.closed:
+            chunk = self.queue.get()
+            if chunk is None:
+                self.closed = True
+            else:
+                yield chunk
+        if not self.complete:
+            raise Aborted()
+
+    def discard(self):
+        """
+        Throw away the rest of the page, for a writer that has given up, so
+        that the renderer isn't left waiting on it.
+        """
+        while not self.closed:
+            self.closed = self.queue.get() is None
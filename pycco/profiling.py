@@ -0,0 +1,222 @@
+"""
+Timing hooks for the stages Pycco goes through for every file it documents.
+
+Any number of callbacks can be registered with `register`; each one is called
+as `callback(source, stage, seconds)` whenever a stage finishes. When nothing
+is registered the hooks cost next to nothing.
+
+Stages can be nested, as when a stage pulls its input from a lazy iterator
+that is timed too. The time of a stage only counts what the stages nested in
+it didn't, so that nothing is counted twice. `Profile` is a callback that
+collects the timings and prints a summary of the slowest files and stages,
+and is what `pycco --profile` uses.
+"""
+from __future__ import print_function
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+__all__ = ('STAGES', 'Profile', 'Recorder', 'register', 'unregister',
+           'clear', 'enabled', 'report', 'source_file', 'stage', 'timed_iter',
+           'accumulate')
+
+# The stages, in the order they happen.
+STAGES = ('read', 'language', 'parse', 'jb_highlight', 'highlight',
+          'markdown', 'template', 'write')
+
+_callbacks = []
+
+# The source file being documented by the current thread, and the time taken
+# by the stages nested in the one it is timing.
+_current = threading.local()
+
+
+def register(callback):
+    """
+    Call `callback(source, stage, seconds)` after every stage of every file.
+    """
+    _callbacks.append(callback)
+    return callback
+
+
+def unregister(callback):
+    if callback in _callbacks:
+        _callbacks.remove(callback)
+
+
+def clear():
+    """
+    Unregister every callback.
+    """
+    del _callbacks[:]
+
+
+def enabled():
+    return bool(_callbacks)
+
+
+def report(source, name, seconds):
+    for callback in list(_callbacks):
+        callback(source, name, seconds)
+
+
+def _start():
+    # Start timing a stage, and set aside the nested time of the one around it.
+    outer = getattr(_current, 'nested', 0.0)
+    _current.nested = 0.0
+    return time.time(), outer
+
+
+def _stop(start, outer):
+    # Return the time taken by the stage less that of the ones nested in it,
+    # and count all of it as nested in the stage around it.
+    elapsed = time.time() - start
+    own = elapsed - _current.nested
+    _current.nested = outer + elapsed
+    return own
+
+
+@contextmanager
+def source_file(source):
+    """
+    Attribute the stages timed inside this block to `source`.
+    """
+    previous = getattr(_current, 'source', None)
+    _current.source = source
+    try:
+        yield
+    finally:
+        _current.source = previous
+
+
+@contextmanager
+def stage(name, source=None):
+    """
+    Time the block as the stage `name` of `source`, which defaults to the file
+    set by `source_file`.
+    """
+    if not _callbacks:
+        yield
+        return
+    start = _start()
+    try:
+        yield
+    finally:
+        report(source if source is not None else getattr(_current, 'source', None),
+               name, _stop(*start))
+
+
+def timed_iter(name, iterable, source=None):
+    """
+    Pass the items of `iterable` through, timing the work it does to produce
+    them as the stage `name`. The total is reported once it is exhausted.
+    """
+    if not _callbacks:
+        for item in iterable:
+            yield item
+        return
+    if source is None:
+        source = getattr(_current, 'source', None)
+    total = 0
+    iterator = iter(iterable)
+    while True:
+        start = _start()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            total += _stop(*start)
+        yield item
+    report(source, name, total)
+
+
+@contextmanager
+def accumulate(name, function, source=None):
+    """
+    Yield a wrapper around `function` that times every call to it. The total
+    is reported as the stage `name` at the end of the block.
+    """
+    if not _callbacks:
+        yield function
+        return
+    if source is None:
+        source = getattr(_current, 'source', None)
+    total = [0]
+
+    def timed(*args, **kwargs):
+        start = _start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            total[0] += _stop(*start)
+
+    try:
+        yield timed
+    finally:
+        report(source, name, total[0])
+
+
+class Recorder(object):
+    """
+    A callback that keeps the timings it is given in a list, for pool workers
+    to hand back to the parent process.
+    """
+
+    def __init__(self):
+        self.timings = []
+
+    def __call__(self, source, name, seconds):
+        self.timings.append((source, name, seconds))
+
+    def take(self):
+        timings, self.timings = self.timings, []
+        return timings
+
+
+class Profile(object):
+    """
+    A callback that adds up the time spent in each stage of each file.
+    """
+
+    def __init__(self):
+        self.files = defaultdict(lambda: defaultdict(float))
+
+    def __call__(self, source, name, seconds):
+        self.files[source][name] += seconds
+
+    def stage_totals(self):
+        totals = defaultdict(float)
+        for stages in self.files.values():
+            for name, seconds in stages.items():
+                totals[name] += seconds
+        return totals
+
+    def summary(self, limit=10):
+        """
+        Describe the stages by total time, and the `limit` slowest files with
+        the time each of their stages took.
+        """
+        totals = self.stage_totals()
+        overall = sum(totals.values()) or 1
+        lines = ['pycco profile: {} files, {:.3f}s'.format(
+            len(self.files), sum(totals.values()))]
+
+        lines.append('  slowest stages:')
+        names = sorted(totals, key=lambda name: (-totals[name], name))
+        for name in names:
+            lines.append('    {:<14} {:9.3f}s {:6.1%}'.format(
+                name, totals[name], totals[name] / overall))
+
+        lines.append('  slowest files:')
+        files = sorted(self.files.items(),
+                       key=lambda item: (-sum(item[1].values()), str(item[0])))
+        for source, stages in files[:limit]:
+            breakdown = ', '.join('{} {:.3f}s'.format(name, stages[name])
+                                  for name in STAGES if name in stages)
+            lines.append('    {:9.3f}s {} ({})'.format(
+                sum(stages.values()), source, breakdown))
+        return '\n'.join(lines)
@@ -0,0 +1,98 @@
+"""
+The client-side search index written with `pycco --search`. Every page, its
+`=== section ===` anchors and the Service classes it defines are taken from
+the cross-reference index of the build, and split into shards by the first
+two characters of each word of their names. The search box in the page
+template loads `search/shards.js` to learn which shards exist, then only the
+shard for what has been typed, so a lookup never loads the whole index.
+
+Shards are JavaScript rather than JSON so that they load from `file://` too.
+"""
+import json
+import os
+import posixpath
+import re
+from os import path
+
+from pycco.compat import compat_items
+from pycco.files import write_if_changed
+
+
+__all__ = ('search_entries', 'build_shards', 'write_search_index')
+
+# Name of the search index directory, relative to the output directory.
+SEARCH_DIR = 'search'
+
+# Words of a name: runs of lower case letters and digits, capitalized words
+# and acronyms, so `OrdersService` and `order-list` both split in two.
+word_matcher = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+
+def search_entries(xref, outdir):
+    """
+    Yield a `[name, url, kind]` entry for every page in the `xref` index,
+    every anchor on it and every Service class it defines, with `url`
+    relative to `outdir`.
+    """
+    for source, entry in sorted(compat_items(xref.sources)):
+        url = path.relpath(entry['dest'], outdir).replace(os.sep, posixpath.sep)
+        yield [path.basename(source), url, 'file']
+        for anchor in entry['anchors']:
+            yield [anchor, u'{}#{}'.format(url, anchor), 'section']
+        for service in entry['services']:
+            yield [service, u'{}#{}'.format(url, service.lower()), 'service']
+
+
+def shard_names(name):
+    """
+    The shards `name` is found in: the first two characters of its words.
+    """
+    names = set()
+    for word in word_matcher.findall(name):
+        if len(word) >= 2:
+            names.add(word[:2].lower())
+    return names
+
+
+def build_shards(entries):
+    """
+    Sort `entries` into shards, keyed by shard name.
+    """
+    shards = {}
+    for entry in entries:
+        for name in shard_names(entry[0]):
+            shards.setdefault(name, []).append(entry)
+    return shards
+
+
+def write_search_index(xref, outdir):
+    """
+    Write the search index of the build described by `xref` into `outdir`.
+    Shards whose contents haven't changed are left alone, and shards that
+    are no longer needed are removed. Returns the names of the shards that
+    were written, with `shards` for the list of shards.
+    """
+    directory = path.join(outdir, SEARCH_DIR)
+    if not path.isdir(directory):
+        os.makedirs(directory)
+
+    shards = build_shards(search_entries(xref, outdir))
+    written = []
+    for name, entries in sorted(compat_items(shards)):
+        data = u'pyccoSearchShard({}, {});\n'.format(
+            json.dumps(name), json.dumps(entries, separators=(',', ':')))
+        if write_if_changed(path.join(directory, name + '.js'),
+                            data.encode('utf-8')):
+            written.append(name)
+
+    names = sorted(shards)
+    data = u'pyccoSearchShards({});\n'.format(
+        json.dumps(names, separators=(',', ':')))
+    if write_if_changed(path.join(directory, 'shards.js'), data.encode('utf-8')):
+        written.append('shards')
+
+    for filename in os.listdir(directory):
+        name, ext = path.splitext(filename)
+        if ext == '.js' and name != 'shards' and name not in shards:
+            os.remove(path.join(directory, filename))
+    return written
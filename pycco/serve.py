@@ -0,0 +1,391 @@
+"""
+`pycco --serve`: documentation rendered when it is asked for, rather than
+for the whole tree up front.
+
+Request paths are mapped back to sources by computing `destination()` for
+every file found under the source arguments. Rendered pages are kept in an
+LRU bounded by their total size, and checked against the size and mtime of
+their source, then its hash, before they are served again. Every page has an
+ETag, so a browser revalidating an unchanged page gets a `304`.
+
+The sources are scanned when the site starts, and again only when files come
+or go, so a request for a page that doesn't exist never walks the tree.
+`index.html` is generated from the latest scan. Pages carry a small script
+that listens for server-sent events on `/__pycco__/events`, and reloads when
+their source, or for the index the set of files, changes.
+
+Changes are seen through watchdog when it is installed. Otherwise the site is
+polled, but only while someone is listening for events, and a poll stats only
+the directories found by the last scan and the sources of the pages that have
+been served.
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from os import path
+
+from pycco.cache import LRUCache, SectionCache
+from pycco.watch import ChangeBatcher
+import pycco.generate_index as generate_index
+import pycco.main as pycco
+from pycco_resources import css as pycco_css
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+
+
+__all__ = ('DocsSite', 'serve')
+
+EVENTS_PATH = "/__pycco__/events"
+
+RELOAD_SCRIPT = u"""<script>
+new EventSource("%s").onmessage = function (event) {
+  var paths = event.data.split(" "), here = location.pathname;
+  if (here.charAt(here.length - 1) === "/") here += "index.html";
+  if (paths.indexOf(here) >= 0) location.reload();
+};
+</script>
+""" % EVENTS_PATH
+
+
+def _signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def add_reload_script(html):
+    body_end = html.rfind(b"</body>")
+    if body_end < 0:
+        body_end = len(html)
+    return html[:body_end] + RELOAD_SCRIPT.encode("utf-8") + html[body_end:]
+
+
+class DocsSite(object):
+    """
+    The pages of the documentation for `sources`, rendered on demand. Up to
+    `max_bytes` of rendered pages are kept in memory.
+    """
+
+    def __init__(self, sources, outdir="docs", preserve_paths=True,
+                 language=None, encoding="utf8", max_bytes=64 << 20):
+        self.sources = sources
+        self.outdir = outdir
+        self.preserve_paths = preserve_paths
+        self.language = language
+        self.encoding = encoding
+        self.settings = u"{}\0{}\0{}".format(bool(preserve_paths), language,
+                                             encoding).encode("utf-8")
+        self.cache = SectionCache()
+        self.rendered = LRUCache(max_bytes, sizeof=lambda entry: len(entry[2]))
+        self.pages = {}
+        self.known = {}
+        self.directories = {}
+
+        # The signature of the source of every page served, as it was then.
+        self.watched = {}
+
+        # Changes seen by `poll` or `update`, as `(generation, paths)`.
+        self.generation = 0
+        self.changes = deque(maxlen=100)
+        self.changed = threading.Condition()
+        self.listeners = 0
+        self.scan()
+
+    def url(self, source):
+        dest = pycco.destination(source, preserve_paths=self.preserve_paths,
+                                 outdir=self.outdir)
+        return "/" + path.relpath(dest, self.outdir).replace(os.sep, "/")
+
+    def scan(self):
+        """
+        Find every source again, with the directories they are in, and map
+        the path of its page to it. Returns whether the pages have changed.
+        """
+        sources, directories = set(), {}
+        for source in self.sources:
+            if path.isdir(source):
+                for dirpath, _, filenames in os.walk(source):
+                    directories[dirpath] = _signature(dirpath)
+                    sources.update(path.join(dirpath, f) for f in filenames)
+            else:
+                sources.add(source)
+                directory = path.dirname(path.abspath(source))
+                directories[directory] = _signature(directory)
+
+        pages = dict((self.url(s), s) for s in sources)
+        changed = set(pages) != set(self.pages)
+        self.pages, self.directories = pages, directories
+        self.known = dict((path.abspath(s), s) for s in sources)
+        return changed
+
+    def source_for(self, url):
+        return self.pages.get(url)
+
+    def page(self, source):
+        """
+        Return the ETag and HTML of the page for `source`, rendering it only
+        if the source has changed since it was last rendered.
+        """
+        stat = os.stat(source)
+        stat = self.watched[source] = (stat.st_mtime, stat.st_size)
+        entry = self.rendered.get(source)
+        if entry is not None and entry[0] == stat:
+            return entry[1], entry[2]
+
+        with open(source, "rb") as f:
+            raw = f.read()
+        etag = '"{}"'.format(hashlib.sha1(self.settings + b"\0" + raw).hexdigest())
+        if entry is not None and entry[1] == etag:
+            self.rendered[source] = (stat, etag, entry[2])
+            return etag, entry[2]
+
+        try:
+            html = pycco._generate_documentation(
+                source, raw.decode(self.encoding), self.outdir,
+                self.preserve_paths, self.language, cache=self.cache)
+        finally:
+            self.cache.trim()
+        html = add_reload_script(html)
+        self.rendered[source] = (stat, etag, html)
+        return etag, html
+
+    def index(self):
+        """
+        Return the ETag and HTML of the index of every page.
+        """
+        urls = sorted(self.pages)
+        dests = [path.join(self.outdir, *url[1:].split("/")) for url in urls]
+        etag = '"{}"'.format(hashlib.sha1(
+            u"\0".join(urls).encode("utf-8")).hexdigest())
+        html = generate_index.generate_index(dests, self.outdir)
+        return etag, add_reload_script(html)
+
+    def poll(self):
+        """
+        Look for changes since the last poll, and tell anyone waiting in
+        `wait_for_changes` the paths of the pages involved. Only the
+        directories and the sources of the pages served are looked at: the
+        pages are mapped again when a directory has changed.
+        """
+        paths = []
+        directories = list(self.directories.items())
+        if any(_signature(d) != signature for d, signature in directories):
+            if self.scan():
+                paths.append("/index.html")
+
+        for source, signature in list(self.watched.items()):
+            current = _signature(source)
+            if current == signature:
+                continue
+            if current is None:
+                del self.watched[source]
+            else:
+                self.watched[source] = current
+            paths.append(self.url(source))
+        return self.notify(sorted(paths))
+
+    def update(self, changed):
+        """
+        Take the paths a file system watcher has seen change, and tell anyone
+        waiting in `wait_for_changes` the paths of the pages involved. The
+        pages are mapped again if any of them isn't a known source.
+        """
+        known = self.known
+        paths = []
+        if any(p not in known or not path.exists(p) for p in changed):
+            if self.scan():
+                paths.append("/index.html")
+        sources = set(known.get(p) or self.known.get(p) for p in changed)
+        paths.extend(self.url(s) for s in sources if s is not None)
+        return self.notify(sorted(paths))
+
+    def notify(self, paths):
+        if paths:
+            with self.changed:
+                self.generation += 1
+                self.changes.append((self.generation, paths))
+                self.changed.notify_all()
+        return paths
+
+    def listen(self):
+        """
+        Count a new listener for changes, and return the current generation.
+        """
+        with self.changed:
+            self.listeners += 1
+            return self.generation
+
+    def stop_listening(self):
+        with self.changed:
+            self.listeners -= 1
+
+    def wait_for_changes(self, generation, timeout=None):
+        """
+        Wait for changes after `generation`, and return the latest generation
+        and the paths of the pages changed since.
+        """
+        with self.changed:
+            if self.generation == generation:
+                self.changed.wait(timeout)
+            paths = set()
+            for change_generation, change_paths in self.changes:
+                if change_generation > generation:
+                    paths.update(change_paths)
+            return self.generation, sorted(paths)
+
+
+class DocsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        site = self.server.site
+        url = unquote(self.path.split("?", 1)[0])
+        if url == EVENTS_PATH:
+            return self.send_events(site)
+        if url == "/pycco.css":
+            return self.send_page('"css"', pycco_css.encode("utf-8"),
+                                  "text/css")
+
+        try:
+            if url in ("/", "/index.html"):
+                etag, html = site.index()
+            else:
+                source = site.source_for(url)
+                if source is None:
+                    return self.send_error(404)
+                etag, html = site.page(source)
+        except (OSError, IOError):
+            return self.send_error(404)
+        except Exception as e:
+            return self.send_error(500, "{}: {}".format(type(e).__name__, e))
+        self.send_page(etag, html, "text/html")
+
+    def send_page(self, etag, body, content_type):
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, site):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        generation = site.listen()
+        try:
+            while True:
+                generation, paths = site.wait_for_changes(generation, 15)
+                if paths:
+                    message = u"data: {}\n\n".format(" ".join(paths))
+                else:
+                    # A comment, to find out whether the browser has gone.
+                    message = u": ping\n\n"
+                self.wfile.write(message.encode("utf-8"))
+                self.wfile.flush()
+        except (OSError, IOError):
+            pass
+        finally:
+            site.stop_listening()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DocsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, site):
+        HTTPServer.__init__(self, address, DocsHandler)
+        self.site = site
+
+
+def _observe(site, batcher):
+    """
+    Watch the sources of `site` with watchdog, feeding the paths of every
+    event to `batcher`, and return the observer. Returns `None` if watchdog
+    isn't installed.
+    """
+    try:
+        import watchdog.events
+        import watchdog.observers
+    except ImportError:
+        return None
+
+    class ChangeHandler(watchdog.events.FileSystemEventHandler):
+
+        def on_any_event(self, event):
+            paths = [event.src_path, getattr(event, "dest_path", None)]
+            batcher.add(*[path.abspath(p) for p in paths if p])
+
+    # As in `pycco --watch`: directories are watched with everything beneath
+    # them, single files through the directory they are in.
+    observer = watchdog.observers.Observer()
+    watches = {}
+    for source in site.sources:
+        if path.isdir(source):
+            watches[path.abspath(source)] = True
+        else:
+            watches.setdefault(path.dirname(path.abspath(source)), False)
+    for directory, recursive in sorted(watches.items()):
+        observer.schedule(ChangeHandler(), path=directory, recursive=recursive)
+    observer.start()
+    return observer
+
+
+def serve(sources, outdir="docs", preserve_paths=True, language=None,
+          encoding="utf8", port=8000, host="127.0.0.1", interval=1.0):
+    """
+    Serve the documentation for `sources` at `http://host:port/` until
+    interrupted. Without watchdog, the sources are polled every `interval`
+    seconds while a page is open to be reloaded.
+    """
+    site = DocsSite(sources, outdir=outdir, preserve_paths=preserve_paths,
+                    language=language, encoding=encoding)
+    server = DocsServer((host, port), site)
+    batcher = ChangeBatcher()
+    observer = _observe(site, batcher)
+
+    def watch():
+        while True:
+            if observer is not None:
+                site.update(batcher.wait())
+                continue
+            if site.listeners:
+                site.poll()
+            time.sleep(interval)
+
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+
+    print("pycco: serving documentation on http://{}:{}/".format(
+        host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if observer is not None:
+            observer.stop()
+            observer.join()
@@ -0,0 +1,65 @@
+"""
+Support for `pycco --watch`: collecting the paths of file system events into
+batches, so that a burst of events, like an editor saving a file through a
+temporary copy, leads to one rebuild of each file involved.
+"""
+import threading
+import time
+
+
+__all__ = ('ChangeBatcher',)
+
+
+class ChangeBatcher(object):
+    """
+    A set of changed paths, handed out once no new change has come in for
+    `window` seconds. `add` may be called from any thread.
+    """
+
+    def __init__(self, window=0.2, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.paths = set()
+        self.last_change = None
+
+    def add(self, *paths):
+        with self.condition:
+            self.paths.update(paths)
+            self.last_change = self.clock()
+            self.condition.notify_all()
+
+    def ready(self):
+        """
+        Return the pending paths and start a new batch, if the current batch
+        has been quiet for `window` seconds. Otherwise return an empty set.
+        """
+        with self.condition:
+            if not self.paths or self.clock() - self.last_change < self.window:
+                return set()
+            paths, self.paths = self.paths, set()
+            return paths
+
+    def wait(self, timeout=None):
+        """
+        Block until a batch is ready and return it. With nothing pending,
+        give up after `timeout` seconds and return an empty set; once a
+        change has come in, wait for the batch to go quiet regardless.
+        """
+        start = self.clock()
+        with self.condition:
+            while True:
+                paths = self.ready()
+                if paths:
+                    return paths
+
+                now = self.clock()
+                if self.paths:
+                    delay = self.window - (now - self.last_change)
+                elif timeout is None:
+                    delay = None
+                elif now - start >= timeout:
+                    return set()
+                else:
+                    delay = timeout - (now - start)
+                self.condition.wait(delay)
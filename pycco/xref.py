@@ -0,0 +1,159 @@
+"""
+The cross-reference index of a build. Before any page is rendered, every
+source is scanned for the anchors of its `=== sections ===`, the data
+Service classes it defines, and the references it makes to other files. Links
+are then resolved with a dictionary lookup, relative to the page they are on,
+and the ones that point nowhere are reported together.
+"""
+import posixpath
+from os import path
+
+
+__all__ = ('CrossReferences',)
+
+
+def _href(dest, from_dest):
+    """
+    The link from the page at `from_dest` to the page at `dest`.
+    """
+    href = path.relpath(dest, path.dirname(from_dest) or '.')
+    return href.replace(path.sep, posixpath.sep)
+
+
+class CrossReferences(object):
+    """
+    What every page of a build is called, and what it contains.
+    """
+
+    def __init__(self):
+        # Name a file can be referred to by: its path as given, normalized,
+        # and its file name alone.
+        self.pages = {}
+        self.anchors = {}
+        # Service class name -> pages defining it.
+        self.services = {}
+        # (source, dest, kind, target) for every reference made, with `kind`
+        # either 'page' or 'service'.
+        self.references = []
+        # What was found in each source, in the form the manifest keeps it.
+        self.sources = {}
+
+    def add_page(self, source, dest, anchors=(), services=(), references=()):
+        """
+        Record the page `dest`, documenting `source`, with its section
+        `anchors`, the Service classes it defines, and its `references` as
+        `(kind, target)` pairs.
+        """
+        for name in set([path.normpath(source), path.basename(source)]):
+            self.pages.setdefault(name, []).append(dest)
+        self.anchors.setdefault(dest, set()).update(anchors)
+        for service in services:
+            self.services.setdefault(service, []).append(dest)
+        for kind, target in references:
+            self.references.append((source, dest, kind, target))
+        self.sources[source] = {
+            'dest': dest,
+            'anchors': sorted(anchors),
+            'services': list(services),
+            'references': [[kind, target] for kind, target in references],
+        }
+
+    def links(self, source):
+        """
+        Where each reference made by `source` leads, keyed by `kind:target`,
+        with None for the ones that lead nowhere. A page only has to be built
+        again for its links when this changes.
+        """
+        entry = self.sources[source]
+        page = self.for_page(entry['dest'])
+        return dict(('{}:{}'.format(kind, target), page.resolve(kind, target))
+                    for kind, target in entry['references'])
+
+    def describe(self, source):
+        """
+        Everything the manifest keeps about `source`: its scan, and its links.
+        """
+        return dict(self.sources[source], links=self.links(source))
+
+    def find_page(self, name, from_dest=None):
+        """
+        The page for the file called `name`. When several files have that
+        name, one next to `from_dest` is preferred.
+        """
+        dests = self.pages.get(path.normpath(name)) if name else None
+        if not dests:
+            return None
+        if from_dest is not None:
+            for dest in dests:
+                if path.dirname(dest) == path.dirname(from_dest):
+                    return dest
+        return dests[0]
+
+    def find_service(self, module, classname, from_dest=None):
+        """
+        The page defining the Service `classname`, preferring one whose file
+        is named after `module`.
+        """
+        dests = self.services.get(classname)
+        if not dests:
+            return None
+        for dest in dests:
+            if path.basename(dest).split('.')[0] == module.split('.')[-1]:
+                return dest
+        return dests[0]
+
+    def check(self, kind, target, from_dest):
+        """
+        Whether the reference `target`, of `kind`, made on the page
+        `from_dest`, leads somewhere.
+        """
+        if kind == 'service':
+            module, _, classname = target.rpartition('.')
+            return self.find_service(module, classname, from_dest) is not None
+        name, _, anchor = target.partition('#')
+        dest = self.find_page(name, from_dest)
+        if dest is None:
+            return False
+        return not anchor or anchor in self.anchors.get(dest, ())
+
+    def broken(self):
+        """
+        Every reference that leads nowhere, as `(source, target)` pairs.
+        """
+        return [(source, target)
+                for source, dest, kind, target in self.references
+                if not self.check(kind, target, dest)]
+
+    def for_page(self, dest):
+        return PageReferences(self, dest)
+
+
+class PageReferences(object):
+    """
+    The cross-reference index as seen from the page at `dest`: links are
+    relative to it. Each method returns None for a target that isn't known.
+    """
+
+    def __init__(self, index, dest):
+        self.index = index
+        self.dest = dest
+
+    def resolve(self, kind, target):
+        if kind == 'service':
+            module, _, classname = target.rpartition('.')
+            return self.service(module, classname)
+        name, _, anchor = target.partition('#')
+        return self.page(name, anchor)
+
+    def page(self, name, anchor=None):
+        dest = self.index.find_page(name, self.dest)
+        if dest is None:
+            return None
+        href = _href(dest, self.dest)
+        return '{}#{}'.format(href, anchor) if anchor else href
+
+    def service(self, module, classname):
+        dest = self.index.find_service(module, classname, self.dest)
+        if dest is None:
+            return None
+        return '{}#{}'.format(_href(dest, self.dest), classname.lower())
@@ -1,4 +1,4 @@
-import pystache
+import re
 
 css = """\
 /*--------------------- Layout and Typography ----------------------------*/
@@ -125,6 +125,32 @@ div.code {
 div.clearall {
     clear: both;
 }
+#search {
+  position: fixed;
+  right: 110px; top: 0;
+  padding: 3px 10px;
+  font: 12px Arial;
+  z-index: 1;
+}
+  #search input {
+    width: 200px;
+  }
+  #search_results {
+    background: white;
+    -webkit-box-shadow: 0 0 25px #777; -moz-box-shadow: 0 0 25px #777;
+  }
+    #search_results a {
+      display: block;
+      padding: 5px 10px;
+      text-decoration: none;
+      border-top: 1px solid #eee;
+    }
+      #search_results a:hover {
+        background: #f5f5ff;
+      }
+    #search_results small {
+      color: #999;
+    }
 
 
 /*---------------------- Syntax Highlighting -----------------------------*/
@@ -235,11 +261,171 @@ html = """\
   <div class='clearall'></div>
   {{/sections}}
 </div>
+{{#search}}
+<div id="search" style="display: none">
+  <input type="search" placeholder="Search" autocomplete="off">
+  <div id="search_results"></div>
+</div>
+<script>
+(function () {
+  // The search index is in `search/` next to the stylesheet, split into
+  // shards by the first two characters of each word of the names it holds.
+  var stylesheet = document.querySelector('link[rel="stylesheet"]');
+  var root = stylesheet.getAttribute("href").replace(/pycco\\.css$/, "");
+  var box = document.getElementById("search");
+  var input = box.getElementsByTagName("input")[0];
+  var results = document.getElementById("search_results");
+  var known = {}, shards = {};
+
+  function normalize(text) {
+    return text.toLowerCase().replace(/[^a-z0-9]/g, "");
+  }
+  function escape(text) {
+    return text.replace(/&/g, "&amp;").replace(/</g, "&lt;");
+  }
+  function load(name) {
+    var script = document.createElement("script");
+    script.src = root + "search/" + name + ".js";
+    document.body.appendChild(script);
+  }
+  function show() {
+    var query = normalize(input.value), shard = query.slice(0, 2), html = [];
+    if (shard.length < 2 || !known[shard]) {
+      results.innerHTML = "";
+      return;
+    }
+    if (shards[shard] === undefined) {
+      shards[shard] = null;
+      load(shard);
+    }
+    (shards[shard] || []).forEach(function (entry) {
+      if (html.length < 50 && normalize(entry[0]).indexOf(query) >= 0) {
+        html.push('<a href="' + root + escape(entry[1]) + '">' +
+                  escape(entry[0]) + " <small>" + entry[2] + "</small></a>");
+      }
+    });
+    results.innerHTML = html.join("");
+  }
+
+  window.pyccoSearchShards = function (names) {
+    names.forEach(function (name) { known[name] = true; });
+    box.style.display = "block";
+  };
+  window.pyccoSearchShard = function (name, entries) {
+    shards[name] = entries;
+    show();
+  };
+  input.addEventListener("input", show);
+  load("shards");
+})();
+</script>
+{{/search}}
 </body>
 """
 
 
+class Template(object):
+    """
+    A page template compiled once and reused for every page. The template is
+    cut around its `{{#sections}}` block: the header and the footer are
+    parsed by Pystache a single time, and the section block is compiled into
+    a list of literal chunks and variable tags. Each section's HTML is spliced
+    straight into that list, so the highlighted code is never handed back to
+    Pystache and never needs its `{{` escaped.
+
+    Compilation, and the import of Pystache, wait until the first page is
+    rendered.
+    """
+
+    section_tag = re.compile(r"^[ \t]*\{\{([#/])\s*sections\s*\}\}[ \t]*\n",
+                             re.MULTILINE)
+    variable_tag = re.compile(r"\{\{(\{?)\s*(\w+)\s*\}?\}\}")
+
+    def __init__(self, source):
+        self.source = source
+        self.renderer = None
+
+    def compile(self):
+        """
+        Compile the template, unless that has been done already.
+        """
+        if self.renderer is not None:
+            return self
+        import pystache
+
+        # Unlike `pystache.render`, `pystache.parse` only takes unicode.
+        source = self.source
+        if isinstance(source, bytes):
+            source = source.decode("utf-8")
+        tags = list(self.section_tag.finditer(source))
+        if [m.group(1) for m in tags] != ["#", "/"]:
+            raise ValueError("A page template needs one {{#sections}} block.")
+        start, end = tags
+
+        self.header = pystache.parse(source[:start.start()])
+        self.footer = pystache.parse(source[end.end():])
+        self.section = self._compile(source[start.end():end.start()])
+        self.renderer = pystache.Renderer()
+        return self
+
+    def _compile(self, block):
+        """
+        Split a section block into alternating literal text and
+        `(name, escape)` pairs. Only plain variable tags are supported.
+        """
+        parts, position = [], 0
+        for match in self.variable_tag.finditer(block):
+            parts.append(block[position:match.start()])
+            parts.append((match.group(2), not match.group(1)))
+            position = match.end()
+        parts.append(block[position:])
+        if any("{{" in part for part in parts[::2]):
+            raise ValueError("Unsupported tag in the {{#sections}} block.")
+        return parts
+
+    def render_header(self, context):
+        self.compile()
+        return self.renderer.render(self.header, context)
+
+    def render_section(self, section, context=None):
+        """
+        Render one section. Names missing from the section are looked up in
+        the page `context`, as Mustache would.
+        """
+        self.compile()
+        output = []
+        for i, part in enumerate(self.section):
+            if i % 2 == 0:
+                output.append(part)
+                continue
+            name, escape = part
+            value = section.get(name)
+            if value is None and context:
+                value = context.get(name)
+            if value is None:
+                continue
+            value = u"{}".format(value)
+            output.append(self.renderer.escape(value) if escape else value)
+        return u"".join(output)
+
+    def iter_render(self, context):
+        """
+        Render the page piece by piece: the header, each of the sections,
+        and then the footer.
+        """
+        yield self.render_header(context)
+        sections = context.get("sections")
+        if isinstance(sections, dict):
+            sections = [sections]
+        for section in sections or ():
+            yield self.render_section(section, context)
+        yield self.renderer.render(self.footer, context)
+
+    def __call__(self, context):
+        return u"".join(self.iter_render(context))
+
+
 def template(source):
-    return lambda context: pystache.render(source, context)
+    return Template(source)
 # Create the template that we will use to generate the Pycco HTML page.
 pycco_template = template(html)
@@ -16,5 +16,5 @@ setup(
         ]
     },
     install_requires=['markdown', 'pygments', 'pystache', 'smartypants'],
-    extras_require={'monitoring': 'watchdog'},
+    extras_require={'monitoring': 'watchdog', 'brotli': 'brotli'},
 )
@@ -0,0 +1,119 @@
+"""
+The line-by-line implementation of `pycco.main.parse` that the current one
+replaced, kept so the two can be checked against each other.
+"""
+import re
+
+
+def legacy_parse(code, language):
+    """
+    Given a string of source code, parse out each comment and the code that
+    follows it, and create an individual **section** for it.
+    Sections take the form:
+
+        { "docs_text": ...,
+          "docs_html": ...,
+          "code_text": ...,
+          "code_html": ...,
+          "num":       ...
+        }
+    """
+
+    lines = code.split("\n")
+    sections = []
+    has_code = docs_text = code_text = ""
+
+    if lines[0].startswith("#!"):
+        lines.pop(0)
+
+    if language["name"] == "python":
+        for linenum, line in enumerate(lines[:2]):
+            if re.search(r'coding[:=]\s*([-\w.]+)', lines[linenum]):
+                lines.pop(linenum)
+                break
+
+    def save(docs, code):
+        if docs or code:
+            sections.append({
+                "docs_text": docs,
+                "code_text": code
+            })
+
+    # Setup the variables to get ready to check for multiline comments
+    multi_line = False
+    multi_string = False
+    multistart, multiend = language.get("multistart"), language.get("multiend")
+    comment_matcher = language['comment_matcher']
+
+    for line in lines:
+        process_as_code = False
+        # Only go into multiline comments section when one of the delimiters is
+        # found to be at the start of a line
+        if multistart and multiend \
+           and any(line.lstrip().startswith(delim) or line.rstrip().endswith(delim)
+                   for delim in (multistart, multiend)):
+            multi_line = not multi_line
+
+            if multi_line \
+               and line.strip().endswith(multiend) \
+               and len(line.strip()) > len(multiend):
+                multi_line = False
+
+            if not line.strip().startswith(multistart) and not multi_line \
+               or multi_string:
+
+                process_as_code = True
+
+                if multi_string:
+                    multi_line = False
+                    multi_string = False
+                else:
+                    multi_string = True
+
+            else:
+                # Get rid of the delimiters so that they aren't in the final
+                # docs
+                line = line.replace(multistart, '')
+                line = line.replace(multiend, '')
+                docs_text += line.strip() + '\n'
+                indent_level = re.match(r"\s*", line).group(0)
+
+                if has_code and docs_text.strip():
+                    save(docs_text, code_text[:-1])
+                    code_text = code_text.split('\n')[-1]
+                    has_code = docs_text = ''
+
+        elif multi_line:
+            # Remove leading spaces
+            if re.match(r' {{{:d}}}'.format(len(indent_level)), line):
+                docs_text += line[len(indent_level):] + '\n'
+            else:
+                docs_text += line + '\n'
+
+        elif re.match(comment_matcher, line):
+            if has_code:
+                save(docs_text, code_text)
+                has_code = docs_text = code_text = ''
+            docs_text += re.sub(comment_matcher, "", line) + "\n"
+
+        else:
+            process_as_code = True
+
+        if process_as_code:
+            if code_text and any(line.lstrip().startswith(x)
+                                 for x in ['class ', 'def ', '@']):
+                if not code_text.lstrip().startswith("@"):
+                    save(docs_text, code_text)
+                    code_text = has_code = docs_text = ''
+
+            # Split yamls on top level list elements
+            if code_text and language["name"] == 'yaml' and line.startswith('-'):
+                save(docs_text, code_text)
+                code_text = has_code = docs_text = ''
+
+            has_code = True
+            code_text += line + '\n'
+
+    save(docs_text, code_text)
+
+    return sections
@@ -3,12 +3,15 @@ import os
 import tempfile
 import time
 import os.path
+import re
+import sys
 import pytest
 from hypothesis import given, example, assume
-from hypothesis.strategies import lists, text, booleans, choices, none
+from hypothesis.strategies import lists, text, booleans, choices, none, sampled_from
 
 import pycco.generate_index as generate_index
 import pycco.main as p
+from tests.legacy import legacy_parse
 
 
 PYTHON = p.languages['.py']
@@ -16,6 +19,18 @@ PYCCO_SOURCE = 'pycco/main.py'
 FOO_FUNCTION = """def foo():\n    return True"""
 
 
+@pytest.fixture(autouse=True, scope="session")
+def cache_home(tmpdir_factory):
+    # Keep the section cache of every build out of the user's own.
+    home = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = str(tmpdir_factory.mktemp("cache"))
+    yield
+    if home is None:
+        del os.environ["XDG_CACHE_HOME"]
+    else:
+        os.environ["XDG_CACHE_HOME"] = home
+
+
 def get_language(choice):
     return choice(list(p.languages.values()))
 
@@ -188,3 +203,790 @@ def test_flatten_sources(tmpdir):
 
     # Make sure that the lists are the same
     assert sorted(expected_sources) == sorted(flattened)
+
+
+def test_process_parallel_matches_serial(tmpdir, monkeypatch):
+    for name in ["a.py", "b.py", "c.py"]:
+        tmpdir.join("src", name).write(
+            "# Docs for {}\n".format(name) + FOO_FUNCTION, ensure=True)
+    tmpdir.join("src", "bad.py").write_binary(b"# \xff\xfe\n")
+    sources = [str(tmpdir.join("src"))]
+
+    indexes = {}
+    monkeypatch.setattr(generate_index, "generate_index",
+                        lambda files, outdir: indexes.setdefault(outdir, files) and b"")
+
+    serial, parallel = str(tmpdir.join("serial")), str(tmpdir.join("parallel"))
+    p.process(sources, outdir=serial, index=True, skip=True)
+    # The workers write their own pages, with no I/O threads behind them.
+    from multiprocessing import pool
+    monkeypatch.setattr(pool, "ThreadPool", None)
+    p.process(sources, outdir=parallel, index=True, skip=True, jobs=2)
+
+    serial_files = [os.path.relpath(f, serial) for f in indexes[serial]]
+    assert serial_files == [os.path.relpath(f, parallel)
+                            for f in indexes[parallel]]
+    for f in indexes[serial]:
+        with open(f, "rb") as s, open(os.path.join(parallel, os.path.relpath(f, serial)), "rb") as d:
+            assert s.read().replace(serial.encode(), b"") == d.read().replace(parallel.encode(), b"")
+
+    with pytest.raises(UnicodeDecodeError):
+        p.process(sources, outdir=parallel, jobs=2)
+
+
+def test_process_skips_unchanged_files(tmpdir, capsys):
+    source = tmpdir.join("src", "a.py")
+    source.write("# Docs\n" + FOO_FUNCTION, ensure=True)
+    outdir = str(tmpdir.join("docs"))
+
+    p.process([str(source)], outdir=outdir)
+    assert "a.py" in capsys.readouterr().out
+    assert os.path.exists(os.path.join(outdir, ".pycco-manifest"))
+
+    # Touching the file without changing it doesn't trigger a rebuild.
+    os.utime(str(source), (0, 0))
+    p.process([str(source)], outdir=outdir, index=True)
+    assert "a.py" not in capsys.readouterr().out
+    with open(os.path.join(outdir, "index.html"), "rb") as f:
+        assert b"a.py" in f.read()
+
+    source.write("# New docs\n" + FOO_FUNCTION)
+    p.process([str(source)], outdir=outdir)
+    assert "a.py" in capsys.readouterr().out
+
+    p.process([str(source)], outdir=outdir, force=True)
+    assert "a.py" in capsys.readouterr().out
+
+
+def test_process_records_the_contents_it_rendered(tmpdir, monkeypatch):
+    import hashlib
+    from pycco.manifest import Manifest, build_settings
+    source = tmpdir.join("src", "a.py")
+    source.write("# Docs\n" + FOO_FUNCTION, ensure=True)
+    outdir = str(tmpdir.join("docs"))
+
+    # The file changes after the build has indexed it, but before the page is
+    # rendered: the page is the new contents, and the next build redoes it.
+    real_build_references = p.build_references
+
+    def build_references(*args, **kwargs):
+        xref = real_build_references(*args, **kwargs)
+        source.write("# New docs\n" + FOO_FUNCTION)
+        return xref
+
+    monkeypatch.setattr(p, "build_references", build_references)
+    p.process([str(source)], outdir=outdir, preserve_paths=False,
+              progress=None)
+    assert "New docs" in tmpdir.join("docs", "a.py.html").read()
+    settings = build_settings(preserve_paths=False, language=None,
+                              encoding="utf8", search=False)
+    assert str(source) not in Manifest.load(outdir, settings).entries
+
+    monkeypatch.setattr(p, "build_references", real_build_references)
+    p.process([str(source)], outdir=outdir, preserve_paths=False,
+              progress=None, io_threads=0)
+    entry = Manifest.load(outdir, settings).entries[str(source)]
+    assert entry["digest"] == \
+        hashlib.sha1(source.read_binary()).hexdigest()
+
+
+def test_highlight_reuses_cached_sections(monkeypatch):
+    from pycco.cache import SectionCache
+    cache = SectionCache()
+    source = "# First\n" + FOO_FUNCTION + "\n\n# Second\ndef bar():\n    pass\n"
+    expected = p.highlight(p.parse(source, PYTHON), PYTHON, outdir="docs")
+
+    sections = p.highlight(p.parse(source, PYTHON), PYTHON, outdir="docs",
+                           cache=cache)
+    assert [s["code_html"] for s in sections] == [s["code_html"] for s in expected]
+    assert [s["docs_html"] for s in sections] == [s["docs_html"] for s in expected]
+
+    highlighted = []
+    real_highlight_code = p.highlight_code
+    monkeypatch.setattr(p, "highlight_code", lambda codes, language: highlighted.extend(codes) or real_highlight_code(codes, language))
+    sections = p.highlight(p.parse(source.replace("bar", "baz"), PYTHON),
+                           PYTHON, outdir="docs", cache=cache)
+    assert len(highlighted) == 1
+    assert "baz" in highlighted[0]
+    assert sections[0]["code_html"] == expected[0]["code_html"]
+
+
+def test_section_cache_saves_only_changed_shards(tmpdir):
+    from pycco.cache import SectionCache
+    cache_dir = tmpdir.join("cache")
+    cache = SectionCache(str(cache_dir))
+    cache.set("aa01", u"<p>1</p>")
+    cache.set("bb01", u"<p>2</p>")
+    cache.save()
+    shards = [cache_dir.join("aa.json"), cache_dir.join("bb.json")]
+    assert sorted(os.listdir(str(cache_dir))) == ["aa.json", "bb.json"]
+    for shard in shards:
+        os.utime(str(shard), (0, 0))
+
+    cache = SectionCache(str(cache_dir))
+    assert cache.get("aa01") == u"<p>1</p>"
+    cache.set("bb02", u"<p>3</p>")
+    cache.save()
+    assert list(cache.shards) == ["aa", "bb"]
+    assert [shard.mtime() for shard in shards] == [0, shards[1].mtime()] != [0, 0]
+    assert SectionCache(str(cache_dir), fresh=True).get("bb01") is None
+
+
+def test_section_cache_is_bounded_by_bytes(tmpdir):
+    import json
+    from pycco.cache import SectionCache
+    cache = SectionCache(str(tmpdir), max_bytes=256 * 100)
+    for i in range(10):
+        cache.set("aa{:02}".format(i), u"x" * 30)
+    cache.save()
+    with open(str(tmpdir.join("aa.json"))) as f:
+        assert sorted(json.load(f)) == ["aa07", "aa08", "aa09"]
+
+
+def test_section_cache_keeps_only_first_window(tmpdir, monkeypatch):
+    from pycco.cache import SectionCache
+    monkeypatch.setattr(p, "WINDOW_CHARS", 200)
+    source = tmpdir.join("big.py")
+    source.write("".join("# Section {0}\ndef f{0}():\n    return {0}\n\n".format(i)
+                         for i in range(100)))
+    cache = SectionCache()
+    page = tmpdir.join("big.py.html")
+    p.write_documentation(str(source), str(page), outdir=str(tmpdir),
+                          cache=cache)
+
+    assert "f99" in page.read()
+    cached = sum(len(shard) for shard in cache.shards.values())
+    assert 0 < cached < 20
+    assert len(cache.take_added()) == cached
+
+
+def test_template_keeps_double_stache_in_code():
+    sections = p.highlight(p.parse("# Docs\nx = '{{ y }}'\n", PYTHON), PYTHON,
+                           outdir="docs")
+    rendered = p.generate_html("x.py", sections, outdir="docs").decode("utf-8")
+    assert "{{" in rendered
+    assert "__DOUBLE_OPEN_STACHE__" not in rendered
+    assert rendered.count("<div class='section' id='section-") == len(sections)
+
+
+def test_import_defers_heavy_dependencies():
+    import subprocess
+    script = ("import sys, pycco.main; "
+              "print(sorted(m for m in ('markdown', 'pygments', 'pystache') if m in sys.modules))")
+    output = subprocess.check_output([sys.executable, "-c", script])
+    assert output.strip() == b"[]"
+
+
+def test_languages_are_built_lazily():
+    lua = p.Language(p.languages[".lua"])
+    for key in ("comment_matcher", "lexer"):
+        lua.pop(key, None)
+    assert "lexer" not in lua
+    assert lua["lexer"].name == "Lua"
+    assert lua["comment_matcher"].match("-- comment")
+    with pytest.raises(KeyError):
+        lua["no such key"]
+
+
+def test_process_many_files_reports_progress(tmpdir, monkeypatch):
+    # More files than the default recursion limit allows stack frames.
+    count = sys.getrecursionlimit() + 100
+    for i in range(count):
+        tmpdir.join("src", "{:05d}.py".format(i)).write("", ensure=True)
+    monkeypatch.setattr(p, "_generate_documentation", lambda *args, **kw: b"")
+
+    reports = []
+    p.process([str(tmpdir.join("src"))], outdir=str(tmpdir.join("docs")),
+              progress=lambda *args: reports.append(args))
+    assert [r[0] for r in reports] == list(range(1, count + 1))
+    assert all(r[1] == count and r[4] == "generated" for r in reports)
+    assert [r[2] for r in reports] == sorted(r[2] for r in reports)
+
+
+def test_write_documentation_streams_the_same_page(tmpdir):
+    dest = str(tmpdir.join("main.html"))
+    p.write_documentation(PYCCO_SOURCE, dest, outdir=str(tmpdir))
+    with open(dest, "rb") as f:
+        assert f.read() == p.generate_documentation(PYCCO_SOURCE, outdir=str(tmpdir))
+
+
+# Lines that exercise every branch of `parse`, for every language.
+PARSE_LINES = [
+    "", " ", "x = 1", "    indented", "\tx", "a\r", "-", "- a: 1",
+    "#", "# comment", "  # indented", "// c", "-- c", ";; c", "%% c",
+    '"""', '  """doc', 'doc"""', '"""doc"""', "/*", "*/", "/* c */", " * c",
+    "--[[", "--]]", "=begin", "=end", "{-", "-}", "#|", "|#", "###",
+    "def f():", "class A(object):", "@decorator", "  @decorated",
+    "#!/usr/bin/env python", "# -*- coding: utf-8 -*-",
+]
+
+
+@given(lists(sampled_from(PARSE_LINES) | text()), sampled_from(sorted(p.languages)))
+def test_parse_matches_legacy(lines, ext):
+    code = "\n".join(lines)
+    assert p.parse(code, p.languages[ext]) == legacy_parse(code, p.languages[ext])
+
+
+def test_parse_matches_legacy_on_own_source():
+    for source in [PYCCO_SOURCE, "pycco/generate_index.py", "pycco_resources/__init__.py"]:
+        with open(source) as f:
+            code = f.read()
+        assert p.parse(code, PYTHON) == legacy_parse(code, PYTHON)
+
+
+@given(lists(sampled_from(PARSE_LINES) | text()), sampled_from(sorted(p.languages)))
+def test_highlight_code_keeps_section_text(lines, ext):
+    code = "\n".join(lines)
+    language = p.languages[ext]
+    sections = p.parse(code, language)
+    fragments = p.highlight_code([s["code_text"] for s in sections], language)
+    assert len(fragments) == len(sections)
+
+    for section, fragment in zip(sections, fragments):
+        # Strip the tags and undo the escaping Pygments does, `&amp;` last.
+        text = re.sub(r"<[^>]*>", "", fragment)
+        for entity, char in [("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'),
+                             ("&#39;", "'"), ("&amp;", "&")]:
+            text = text.replace(entity, char)
+        expected = section["code_text"].replace("\r\n", "\n").replace("\r", "\n")
+        assert text == expected.lstrip("\n").rstrip()
+
+
+@pytest.mark.parametrize("ext,source", [
+    # Ruby lexes `#DIVIDER` as a single-line comment with class `c1`, while
+    # SQL uses `c1` for `--` comments: neither is matched any more.
+    (".rb", "# a\nputs 1\n# b\nputs 2\n"),
+    (".sql", "-- a\nSELECT 1;\n-- b\nSELECT 2;\n"),
+])
+def test_highlight_code_does_not_need_a_divider(ext, source):
+    language = p.languages[ext]
+    sections = p.parse(source, language)
+    fragments = p.highlight_code([s["code_text"] for s in sections], language)
+    assert ["DIVIDER" in f for f in fragments] == [False, False]
+    assert "1" in fragments[0] and "2" in fragments[1]
+
+
+def test_highlight_code_drops_blank_lines_around_sections():
+    fragments = p.highlight_code(["\n\nx = 1\n\n", "\r\n  y = 2  \r\n"], PYTHON)
+    assert [f.startswith("<span") for f in fragments] == [True, False]
+    assert fragments[1].startswith("  ")
+    assert not any(f.startswith("\n") or f.endswith("\n") for f in fragments)
+
+
+def test_render_markdown_renders_repeated_comments_once(monkeypatch):
+    p.rendered_docs.clear()
+    converted = []
+    import markdown
+    real_convert = markdown.Markdown.convert
+    monkeypatch.setattr(markdown.Markdown, "convert",
+                        lambda self, text: converted.append(text) or real_convert(self, text))
+
+    header = "Copyright *somebody*.\n"
+    source = "".join("# {}def f{}():\n    pass\n".format(header, i) for i in range(5))
+    sections = p.highlight(p.parse(source, PYTHON), PYTHON, outdir="docs")
+    assert converted.count(header) == 1
+    assert all(s["docs_html"] == "<p>Copyright <em>somebody</em>.</p>" for s in sections)
+    assert p.render_markdown("*a*") == markdown.markdown("*a*")
+
+
+def test_lru_cache_evicts_least_recently_used():
+    from pycco.cache import LRUCache
+    lru = LRUCache(2)
+    lru["a"], lru["b"] = 1, 2
+    assert lru.get("a") == 1
+    lru["c"] = 3
+    assert "b" not in lru and lru.get("a") == 1 and lru.get("c") == 3
+
+
+def test_profiling_callbacks_see_every_stage(tmpdir):
+    import pycco.profiling as profiling
+    source = tmpdir.join("a.py")
+    source.write("# Docs\n" + FOO_FUNCTION)
+    outdir = str(tmpdir.join("docs"))
+
+    profile = profiling.register(profiling.Profile())
+    try:
+        p.process([str(source)], outdir=outdir, progress=None,
+                  profile_files=["a.py"])
+    finally:
+        profiling.unregister(profile)
+
+    assert set(profile.files[str(source)]) == set(profiling.STAGES)
+    assert str(source) in profile.summary()
+    assert os.listdir(os.path.join(outdir, ".pycco-profile"))
+
+
+def test_change_batcher_waits_for_quiet():
+    from pycco.watch import ChangeBatcher
+    now = [0.0]
+    batcher = ChangeBatcher(window=0.5, clock=lambda: now[0])
+    batcher.add("/a.py")
+    now[0] = 0.4
+    batcher.add("/a.py", "/b.py")
+    now[0] = 0.8
+    assert batcher.ready() == set()
+    now[0] = 0.9
+    assert batcher.ready() == set(["/a.py", "/b.py"])
+    assert batcher.ready() == set()
+
+
+def test_update_documentation_follows_added_and_deleted_files(tmpdir, capsys):
+    src = tmpdir.join("src")
+    src.join("a.py").write("# A\nx = 1\n", ensure=True)
+    src.join("b.py").write("# B\ny = 2\n")
+    outdir = str(tmpdir.join("docs"))
+    sources = [str(src)]
+    p.process(sources, outdir=outdir, index=True, preserve_paths=False)
+    known = set(p._flatten_sources(sources))
+    os.remove(os.path.join(outdir, "pycco.css"))
+
+    src.join("b.py").remove()
+    src.join("sub", "c.py").write("# C\nz = 3\n", ensure=True)
+    changed = set(str(f) for f in (src.join("b.py"), src.join("sub", "c.py")))
+    known = p.update_documentation(sources, changed, known, outdir,
+                                   preserve_paths=False, index=True)
+
+    assert sorted(os.path.basename(s) for s in known) == ["a.py", "c.py"]
+    assert not os.path.exists(os.path.join(outdir, "b.py.html"))
+    assert os.path.exists(os.path.join(outdir, "c.py.html"))
+    assert not os.path.exists(os.path.join(outdir, "pycco.css"))
+    with open(os.path.join(outdir, "index.html")) as f:
+        index = f.read()
+    assert "c.py.html" in index and "b.py.html" not in index
+
+
+@pytest.mark.skipif(not hasattr(__import__("socket"), "AF_UNIX"),
+                    reason="needs Unix domain sockets")
+def test_daemon_renders_like_generate_documentation(tmpdir):
+    import threading
+    from pycco import daemon
+
+    socket_path = str(tmpdir.join("pycco.sock"))
+    server = daemon.RenderServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        html = daemon.render(socket_path, PYCCO_SOURCE, outdir="docs")
+        assert html == p.generate_documentation(PYCCO_SOURCE, outdir="docs")
+        code = "# Hello\nx = 1\n"
+        assert daemon.render(socket_path, "a.py", code=code) == \
+            p._generate_documentation("a.py", code, "docs", True, None)
+        with pytest.raises(daemon.DaemonError):
+            daemon.render(socket_path, "missing.py")
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.mark.skipif(not hasattr(__import__("socket"), "AF_UNIX"),
+                    reason="needs Unix domain sockets")
+def test_daemon_socket_is_private_and_serves_clients_concurrently(tmpdir):
+    import socket
+    import stat
+    import threading
+    from pycco import daemon
+
+    socket_path = str(tmpdir.join("pycco.sock"))
+    tmpdir.join("pycco.sock").write("not a socket")
+    with pytest.raises(OSError):
+        daemon.RenderServer(socket_path)
+    assert tmpdir.join("pycco.sock").read() == "not a socket"
+    os.remove(socket_path)
+
+    server = daemon.RenderServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        # A client that holds its connection open doesn't block the others.
+        idle.connect(socket_path)
+        code = "# Hello\nx = 1\n"
+        assert daemon.render(socket_path, "a.py", code=code) == \
+            p._generate_documentation("a.py", code, "docs", True, None)
+    finally:
+        idle.close()
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_lru_cache_can_be_bounded_by_size():
+    from pycco.cache import LRUCache
+    cache = LRUCache(10, sizeof=len)
+    cache["a"] = "xxxx"
+    cache["b"] = "yyyy"
+    cache["c"] = "zzzz"
+    assert "a" not in cache and cache.size == 8
+    cache["d"] = "w" * 20
+    assert list(cache.entries) == ["d"]
+
+
+def test_serve_renders_on_request_with_etags(tmpdir):
+    import threading
+    from pycco.serve import DocsServer, DocsSite
+    try:
+        from urllib.request import Request, urlopen
+        from urllib.error import HTTPError
+    except ImportError:
+        from urllib2 import Request, urlopen, HTTPError
+
+    source = tmpdir.join("src", "a.py")
+    source.write("# Hello\nx = 1\n", ensure=True)
+    site = DocsSite([str(tmpdir.join("src"))], preserve_paths=False)
+    assert site.source_for("/a.py.html") == str(source)
+    assert site.poll() == []
+
+    server = DocsServer(("127.0.0.1", 0), site)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+    try:
+        response = urlopen(base + "/a.py.html")
+        etag = response.headers["ETag"]
+        assert b"Hello" in response.read()
+        with pytest.raises(HTTPError) as e:
+            urlopen(Request(base + "/a.py.html", headers={"If-None-Match": etag}))
+        assert e.value.code == 304
+        assert b"a.py.html" in urlopen(base + "/").read()
+        with pytest.raises(HTTPError) as e:
+            urlopen(base + "/b.py.html")
+        assert e.value.code == 404
+        tmpdir.join("src", "b.py").write("# New\n")
+        assert site.source_for("/b.py.html") is None
+        site.poll()
+        assert site.source_for("/b.py.html") == str(tmpdir.join("src", "b.py"))
+
+        source.write("# Goodbye\nx = 2\n")
+        os.utime(str(source), (0, 0))
+        assert site.poll() == ["/a.py.html"]
+        response = urlopen(base + "/a.py.html")
+        assert response.headers["ETag"] != etag
+        assert b"Goodbye" in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_serve_polls_only_directories_and_served_sources(tmpdir, monkeypatch):
+    from pycco.serve import DocsSite
+
+    src = tmpdir.join("src")
+    src.join("a.py").write("# A\n", ensure=True)
+    src.join("b.py").write("# B\n")
+    site = DocsSite([str(src)], preserve_paths=False)
+    site.page(str(src.join("a.py")))
+
+    def walk(*args, **kwargs):
+        raise AssertionError("the tree was walked")
+    monkeypatch.setattr(os, "walk", walk)
+
+    # b.py hasn't been served, and changing it leaves its directory alone.
+    src.join("b.py").write("# Changed\n")
+    assert site.poll() == []
+    src.join("a.py").write("# Changed\n")
+    assert site.poll() == ["/a.py.html"]
+    assert site.poll() == []
+
+    monkeypatch.undo()
+    src.join("c.py").write("# C\n")
+    assert site.update([str(src.join("c.py"))]) == ["/c.py.html", "/index.html"]
+    assert site.source_for("/c.py.html") == str(src.join("c.py"))
+    assert site.update([str(src.join("b.py"))]) == ["/b.py.html"]
+
+    assert site.listen() == site.generation
+    assert site.listeners == 1
+    site.stop_listening()
+    assert site.listeners == 0
+
+
+def test_process_resolves_cross_references_through_index(tmpdir, capsys):
+    src = tmpdir.join("src")
+    src.join("lib", "target.py").write(
+        "# === Link Target ===\nx = 1\n", ensure=True)
+    src.join("app", "main.py").write(
+        "# See [[target.py#link-target]], [[target.py#nowhere]] "
+        "and [[missing.py]]\ny = 2\n", ensure=True)
+    outdir = str(tmpdir.join("docs"))
+    with tmpdir.as_cwd():
+        p.process(["src"], outdir=outdir)
+        with open(os.path.join(outdir, "src", "app", "main.py.html")) as f:
+            html = f.read()
+
+    assert 'href="../lib/target.py.html#link-target"' in html
+    err = capsys.readouterr()[1]
+    assert "src/app/main.py: target.py#nowhere" in err
+    assert "src/app/main.py: missing.py" in err
+    assert "2 broken cross-references" in err
+
+
+def test_process_caps_broken_link_report(tmpdir, capsys):
+    tmpdir.join("src", "a.py").write("# [[missing.py]]\nx = 1\n" * 50,
+                                     ensure=True)
+    outdir = str(tmpdir.join("docs"))
+    p.process([str(tmpdir.join("src"))], outdir=outdir, progress=None)
+    assert capsys.readouterr() == ("", "")
+
+    p.process([str(tmpdir.join("src"))], outdir=outdir, force=True)
+    err = capsys.readouterr()[1]
+    assert err.count("a.py: missing.py") == p.BROKEN_LINKS_SHOWN
+    assert "... and 30 more" in err
+    assert "50 broken cross-references" in err
+
+
+def test_process_rebuilds_pages_whose_links_changed(tmpdir):
+    src = tmpdir.join("src")
+    src.join("a", "a.py").write("# See [[b.py]]\nx = 1\n", ensure=True)
+    src.join("c.py").write("# Unrelated\nz = 3\n")
+    outdir = str(tmpdir.join("docs"))
+    statuses = {}
+
+    def progress(done, total, source, dest, status):
+        statuses[os.path.basename(source)] = status
+
+    p.process([str(src)], outdir=outdir, preserve_paths=False, progress=progress)
+    assert statuses == {"a.py": "generated", "c.py": "generated"}
+
+    p.process([str(src)], outdir=outdir, preserve_paths=False, progress=progress)
+    assert statuses == {"a.py": "unchanged", "c.py": "unchanged"}
+
+    src.join("b", "b.py").write("# B\ny = 2\n", ensure=True)
+    p.process([str(src)], outdir=outdir, preserve_paths=False, progress=progress)
+    assert statuses == {"a.py": "generated", "b.py": "generated",
+                        "c.py": "unchanged"}
+
+
+def test_sharded_index_pages_and_rewrites_changed_directories(tmpdir):
+    outdir = str(tmpdir)
+    files = [os.path.join(outdir, "a", "f{}.py.html".format(i)) for i in range(5)]
+    files.append(os.path.join(outdir, "b", "c", "g.py.html"))
+    written = generate_index.write_sharded_index(files, outdir, page_size=2)
+    assert sorted(written) == ["", "a", "b", os.path.join("b", "c")]
+
+    root = tmpdir.join("index.html").read()
+    assert 'href="a/index.html"' in root and 'href="b/index.html"' in root
+    assert tmpdir.join("a", "index-3.html").check()
+    assert 'href="index-2.html">Next' in tmpdir.join("a", "index.html").read()
+
+    files = files[:4] + files[5:]
+    written = generate_index.write_sharded_index(files, outdir, page_size=2)
+    assert written == ["a"]
+    assert not tmpdir.join("a", "index-3.html").check()
+
+
+def test_search_index_is_sharded_by_word_prefix(tmpdir):
+    from pycco import search
+    src = tmpdir.join("src")
+    src.join("orders.py").write(
+        "# === Order List ===\nclass OrdersService(Service):\n    pass\n",
+        ensure=True)
+    outdir = str(tmpdir.join("docs"))
+    p.process([str(src)], outdir=outdir, preserve_paths=False, search=True,
+              progress=None)
+
+    shards = tmpdir.join("docs", "search")
+    assert 'pyccoSearchShards(["li","or","py","se"])' in shards.join("shards.js").read()
+    assert '["OrdersService","orders.py.html#ordersservice","service"]' in \
+        shards.join("se.js").read()
+    assert '"order-list"' in shards.join("li.js").read()
+    assert search.shard_names("HTTPServer2") == set(["ht", "se"])
+    assert 'id="search"' in tmpdir.join("docs", "orders.py.html").read()
+
+    p.process([str(src)], outdir=outdir, preserve_paths=False, progress=None)
+    assert 'id="search"' not in tmpdir.join("docs", "orders.py.html").read()
+
+
+def test_process_pipeline_matches_streaming_build(tmpdir):
+    for i in range(10):
+        tmpdir.join("src", "m{}.py".format(i)).write(
+            "# Module {}\n".format(i) + FOO_FUNCTION, ensure=True)
+    sources = [str(tmpdir.join("src"))]
+    piped, streamed = str(tmpdir.join("piped")), str(tmpdir.join("streamed"))
+    reports = []
+    p.process(sources, outdir=piped, preserve_paths=False, io_threads=3,
+              progress=lambda *args: reports.append(args))
+    p.process(sources, outdir=streamed, preserve_paths=False, io_threads=0,
+              progress=None)
+
+    assert [r[0] for r in reports] == list(range(1, 11))
+    for i in range(10):
+        name = "m{}.py.html".format(i)
+        assert tmpdir.join("piped", name).read() == \
+            tmpdir.join("streamed", name).read()
+
+
+def test_process_pipeline_streams_pages_to_the_writers(tmpdir, monkeypatch):
+    # Large files aren't read ahead, and pages go to the writers one chunk at
+    # a time.
+    monkeypatch.setattr(p, "PREFETCH_SIZE", 100)
+    monkeypatch.setattr(p, "STREAM_DEPTH", 1)
+    for i in range(4):
+        tmpdir.join("src", "m{}.py".format(i)).write(
+            "# Module {}\n".format(i) + FOO_FUNCTION * i, ensure=True)
+    tmpdir.join("src", "bad.py").write_binary(b"# Bad\nx = '\xff'\n")
+    outdir = str(tmpdir.join("docs"))
+    reports = []
+    p.process([str(tmpdir.join("src"))], outdir=outdir, preserve_paths=False,
+              skip=True, io_threads=2,
+              progress=lambda *args: reports.append(args[-1]))
+
+    assert reports == ["failed"] + ["generated"] * 4
+    assert not tmpdir.join("docs", "bad.py.html").exists()
+    assert not [name for name in os.listdir(outdir) if name.endswith(".tmp")]
+    for i in range(4):
+        source = str(tmpdir.join("src", "m{}.py".format(i)))
+        assert tmpdir.join("docs", "m{}.py.html".format(i)).read_binary() == \
+            p.generate_documentation(source, outdir=outdir,
+                                     preserve_paths=False)
+
+
+@given(lists(sampled_from(PARSE_LINES)), sampled_from(sorted(p.languages)),
+       lists(booleans()))
+def test_parse_lines_matches_parse_text(lines, ext, cuts):
+    code = "\n".join(lines)
+    # Cut the text into chunks at arbitrary points.
+    chunks, start = [], 0
+    for i, cut in enumerate(cuts):
+        if cut and i < len(code):
+            chunks.append(code[start:i])
+            start = i
+    chunks.append(code[start:])
+    assert list(p.split_lines(chunks)) == code.split("\n")
+    assert p.parse(p.split_lines(chunks), p.languages[ext]) == \
+        p.parse(code, p.languages[ext])
+
+
+def test_sections_are_rendered_in_windows(monkeypatch):
+    whole = p.generate_documentation(PYCCO_SOURCE, outdir="docs")
+    monkeypatch.setattr(p, "WINDOW_CHARS", 200)
+    assert p.generate_documentation(PYCCO_SOURCE, outdir="docs") == whole
+    assert b"id='section-0'" in whole
+
+
+def test_iter_source_lines_decodes_across_chunks(tmpdir):
+    source = tmpdir.join("a.py")
+    text = u"# h\xe9llo \u2603\nx = '\xfc'\n"
+    source.write_binary(text.encode("utf-8"))
+    lines = list(p.iter_source_lines(str(source), chunk_size=3))
+    assert lines == text.split("\n")
+
+
+@pytest.mark.parametrize("code, name", [
+    ("#!/usr/bin/env python3.8\nprint(1)\n", "python"),
+    ("#!/bin/sh\necho hi\n", "bash"),
+    ("#!/usr/bin/env node\nvar x;\n", "javascript"),
+    ("-- -*- mode: lua -*-\nlocal x = 1\n", "lua"),
+    ("x = 1\n# vim: set ft=ruby:\n", "ruby"),
+])
+def test_get_language_reads_shebangs_and_modelines(code, name):
+    assert p.get_language("bin/script", code)["name"] == name
+
+
+def test_get_language_guesses_from_a_cached_prefix(monkeypatch):
+    from pygments import lexers
+    guessed = []
+    real_guess = lexers.guess_lexer
+
+    def guess_lexer(text):
+        guessed.append(len(text))
+        return real_guess(text)
+
+    monkeypatch.setattr(lexers, "guess_lexer", guess_lexer)
+    code = "some words without any code in them\n" * 10000
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            p.get_language("script-without-extension", code)
+    assert guessed == [p.GUESS_CHARS]
+
+
+def test_process_renders_identical_files_once(tmpdir, monkeypatch):
+    code = "# Shared\n" + FOO_FUNCTION + "\n\n# More\nx = 1\n"
+    for name in ["a/vendored.py", "b/c/vendored.py", "d/copy.py"]:
+        tmpdir.join("src", name).write(code, ensure=True)
+    highlighted = []
+    highlight_code = p.highlight_code
+    monkeypatch.setattr(p, "highlight_code", lambda codes, language: (
+        highlighted.append(len(codes)) or highlight_code(codes, language)))
+
+    outdir = str(tmpdir.join("docs"))
+    with tmpdir.as_cwd():
+        p.process(["src"], outdir=outdir, progress=None)
+        assert len(highlighted) == 1
+        for name in ["a/vendored.py", "b/c/vendored.py", "d/copy.py"]:
+            dest = p.destination(os.path.join("src", name), outdir=outdir)
+            with open(dest, "rb") as f:
+                assert f.read() == p.generate_documentation(
+                    os.path.join("src", name), outdir=outdir)
+
+
+@pytest.mark.parametrize("io_threads", [0, 2])
+def test_process_only_writes_changed_files(tmpdir, io_threads):
+    for name in ["a.py", "b.py"]:
+        tmpdir.join("src", name).write("# {}\n".format(name) + FOO_FUNCTION,
+                                       ensure=True)
+    outdir = str(tmpdir.join("docs"))
+    cache_dir = tmpdir.join("cache")
+    options = dict(outdir=outdir, preserve_paths=False, index=True,
+                   progress=None, io_threads=io_threads,
+                   cache_dir=str(cache_dir))
+    assert p.process([str(tmpdir.join("src"))], **options) == 4
+
+    page = tmpdir.join("docs", "a.py.html")
+    os.utime(str(page), (0, 0))
+    assert p.process([str(tmpdir.join("src"))], force=True, **options) == 0
+    assert page.mtime() == 0
+
+    records = [tmpdir.join("docs", ".pycco-manifest")] + cache_dir.listdir()
+    assert len(records) > 1
+    for record in records:
+        os.utime(str(record), (0, 0))
+    assert p.process([str(tmpdir.join("src"))], **options) == 0
+    assert [record.mtime() for record in records] == [0] * len(records)
+
+    # The same goes for the record of a paginated index.
+    options["index_page_size"] = 10
+    p.process([str(tmpdir.join("src"))], **options)
+    records.append(tmpdir.join("docs", ".pycco-index"))
+    for record in records:
+        os.utime(str(record), (0, 0))
+    assert p.process([str(tmpdir.join("src"))], **options) == 0
+    assert [record.mtime() for record in records] == [0] * len(records)
+
+    tmpdir.join("src", "a.py").write("# Changed\n" + FOO_FUNCTION)
+    assert p.process([str(tmpdir.join("src"))], **options) == 1
+    assert page.mtime() != 0
+    assert not [f for f in os.listdir(outdir) if f.endswith(".tmp")]
+
+
+def test_process_compresses_changed_outputs(tmpdir, monkeypatch):
+    import gzip
+    from pycco import compress
+    for name in ["a.py", "b.py"]:
+        tmpdir.join("src", name).write("# {}\n".format(name) + FOO_FUNCTION,
+                                       ensure=True)
+    compressed = []
+    gzip_data = compress.COMPRESSORS["gz"]
+    monkeypatch.setitem(compress.COMPRESSORS, "gz", lambda data: (
+        compressed.append(data) or gzip_data(data)))
+    monkeypatch.setattr(compress, "brotli", None)
+
+    outdir = str(tmpdir.join("docs"))
+    options = dict(outdir=outdir, preserve_paths=False, index=True,
+                   progress=None, compress=True)
+    p.process([str(tmpdir.join("src"))], **options)
+    assert len(compressed) == 4
+    for name in ["a.py.html", "b.py.html", "pycco.css", "index.html"]:
+        with gzip.open(os.path.join(outdir, name + ".gz"), "rb") as f:
+            assert f.read() == tmpdir.join("docs", name).read_binary()
+
+    del compressed[:]
+    p.process([str(tmpdir.join("src"))], force=True, **options)
+    os.utime(str(tmpdir.join("docs", "b.py.html")), (0, 0))
+    p.process([str(tmpdir.join("src"))], **options)
+    assert compressed == []
+
+    tmpdir.join("src", "a.py").write("# Changed\n" + FOO_FUNCTION)
+    p.process([str(tmpdir.join("src"))], **options)
+    assert compressed == [tmpdir.join("docs", "a.py.html").read_binary()]